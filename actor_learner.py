@@ -0,0 +1,214 @@
+'''
+Parallel training: K actor processes play SnakeBasic games with epsilon-greedy
+copies of the network and write transitions into shared-memory chunk slots,
+only slot numbers go through queues. The learner (this process) trains QTrainer
+at a replay ratio and publishes new weights back through shared memory.
+'''
+from game import SnakeBasic
+from model import Linear_QNet, QTrainer, QInference
+from replay_buffer import ReplayBuffer
+from console_colors import colors
+from main import MAX_MEMORY, BATCH_SIZE, LR, SNAKE_DIMENSIONS
+
+import os
+import time
+import queue
+import random
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+ARCHITECTURE = (24, 256, 128, 4)
+# sampled transitions per env step the learner aims at
+REPLAY_RATIO = 4.
+
+def actor_epsilon(actor_id: int, actors: int, base: float = .4, alpha: float = 7.):
+    '''
+    Fixed per-actor exploration, from base (actor 0) down to base ** (1 + alpha) (last actor)
+    '''
+    if actors == 1:
+        return base
+    return base ** (1 + alpha * actor_id / (actors - 1))
+
+def _chunk_slots(slots: int, chunk_size: int, state_size: int):
+    '''
+    returns: (states, actions, rewards, next_states, dones) shared tensors, slots chunks of chunk_size transitions
+    '''
+    return tuple(torch.zeros(shape, dtype = dtype).share_memory_() for shape, dtype in (
+        ((slots, chunk_size, state_size), torch.float32),
+        ((slots, chunk_size), torch.int64),
+        ((slots, chunk_size), torch.float32),
+        ((slots, chunk_size, state_size), torch.float32),
+        ((slots, chunk_size), torch.bool),
+    ))
+
+def _actor(actor_id, epsilon, shared_model, version, lock, chunks, free, filled, stop, arena_size, seed):
+    # one core per actor
+    torch.set_num_threads(1)
+    rng = random.Random(seed)
+    game = SnakeBasic(arena_size, seed)
+
+    model = Linear_QNet(shared_model.architecture)
+    inference = QInference(model)
+    local_version = -1
+
+    # numpy views of the slots, a chunk is written in place
+    states, actions, rewards, next_states, dones = (chunk.numpy() for chunk in chunks)
+    chunk_size = actions.shape[1]
+    slot = None
+    scores = []
+    count = 0
+
+    state = np.array(game._get_basic_input_bin(), dtype = np.float32)
+    while not stop.is_set():
+        if slot is None:
+            # don't block forever if the learner is gone
+            try:
+                slot = free.get(timeout = .1)
+            except queue.Empty:
+                continue
+
+        # pick up published weights
+        if version.value != local_version:
+            with lock:
+                model.load_state_dict(shared_model.state_dict())
+                local_version = version.value
+            inference.refresh()
+
+        if rng.random() < epsilon:
+            move = rng.randint(0, 3)
+            game.forget_positions()
+        else:
+            game.follow_policy(local_version)
+            move = inference.act(state)
+
+        reward, done, score = game.tick(move)
+        next_state = np.array(game._get_basic_input_bin(), dtype = np.float32)
+
+        states[slot, count] = state
+        actions[slot, count] = move
+        rewards[slot, count] = reward
+        next_states[slot, count] = next_state
+        dones[slot, count] = done
+        count += 1
+
+        if done:
+            scores.append(score)
+            game.reset()
+            next_state = np.array(game._get_basic_input_bin(), dtype = np.float32)
+        state = next_state
+
+        if count == chunk_size:
+            filled.put((slot, scores))
+            slot = None
+            scores = []
+            count = 0
+
+def _receive(filled, block: bool):
+    '''
+    returns: every (slot, scores) queued, waits a little for the first one when block
+    '''
+    received = []
+    try:
+        received.append(filled.get(timeout = .1) if block else filled.get_nowait())
+        while True:
+            received.append(filled.get_nowait())
+    except queue.Empty:
+        pass
+    return received
+
+def train_parallel(actors: int = None, max_games: int = None, chunk_size: int = 256,
+                   replay_ratio: float = REPLAY_RATIO, publish_every: int = 10, report_every: float = 10.):
+    '''
+    Runs actors processes (all cores but the learner's by default) until max_games are played.
+    The learner aims at replay_ratio sampled transitions per env step, one update at a time with every
+    chunk queued taken in between, so actors never wait on it - when it can't keep up the ratio drops instead.
+
+    returns: trained Linear_QNet
+    '''
+    if actors is None:
+        actors = max(1, (os.cpu_count() or 2) - 1)
+
+    ctx = mp.get_context('spawn')
+
+    model = Linear_QNet(ARCHITECTURE)
+    trainer = QTrainer(model, lr = LR, gamma = .9)
+    memory = ReplayBuffer(MAX_MEMORY, ARCHITECTURE[0])
+
+    # weights the actors read from
+    shared_model = Linear_QNet(ARCHITECTURE)
+    shared_model.load_state_dict(model.state_dict())
+    shared_model.share_memory()
+    version = ctx.Value('i', 0)
+    lock = ctx.Lock()
+
+    # chunk slots the actors fill in place, their numbers pass through free -> actor -> filled -> learner -> free
+    slots = 4 * actors
+    chunks = _chunk_slots(slots, chunk_size, ARCHITECTURE[0])
+    chunk_arrays = [chunk.numpy() for chunk in chunks]
+    free = ctx.Queue()
+    filled = ctx.Queue()
+    for slot in range(slots):
+        free.put(slot)
+    stop = ctx.Event()
+
+    processes = [ctx.Process(target = _actor, daemon = True,
+                             args = (i, actor_epsilon(i, actors), shared_model, version, lock, chunks, free, filled, stop,
+                                     SNAKE_DIMENSIONS, i))
+                 for i in range(actors)]
+    for process in processes:
+        process.start()
+
+    n_games = 0
+    record = 0
+    env_steps = 0
+    updates = 0
+    replayed = 0
+    start = report_time = time.perf_counter()
+
+    try:
+        while max_games is None or n_games < max_games:
+            # updates behind the replay ratio
+            due = int(replay_ratio * env_steps / BATCH_SIZE) - updates
+
+            for slot, scores in _receive(filled, block = due <= 0):
+                memory.push_many(*(array[slot] for array in chunk_arrays))
+                free.put(slot)
+                env_steps += chunk_size
+
+                for score in scores:
+                    n_games += 1
+                    if score > record:
+                        record = score
+                        model.save()
+
+            if due > 0:
+                trainer.train_step(*memory.sample(BATCH_SIZE))
+                updates += 1
+                replayed += min(BATCH_SIZE, len(memory))
+
+                # publish weights
+                if updates % publish_every == 0:
+                    with lock, torch.no_grad():
+                        for shared, local in zip(shared_model.parameters(), model.parameters()):
+                            shared.copy_(local)
+                        version.value += 1
+
+            now = time.perf_counter()
+            if now - report_time > report_every:
+                report_time = now
+                print(f'{colors.GREEN}»»»»{colors.ENDC}Games {n_games}{colors.GREEN}««««{colors.ENDC}')
+                print(f'\t->record = {record}')
+                print(f'\t->env steps/sec = {env_steps / (now - start):.0f}')
+                print(f'\t->updates/sec = {updates / (now - start):.1f}')
+                print(f'\t->replay ratio = {replayed / max(env_steps, 1):.2f}')
+    finally:
+        stop.set()
+        # drain so the actors' queue feeders can flush and exit
+        while any(process.is_alive() for process in processes):
+            _receive(filled, block = True)
+        for process in processes:
+            process.join()
+
+    return model
@@ -0,0 +1,609 @@
+'''
+Throughput benchmarks for the hot paths.
+
+usage: python benchmark.py [name ...] [--output results.json] [--compare old.json] [--quick]
+
+Every case reports ops/sec plus allocations measured with tracemalloc on a separate run:
+bytes allocated per op (the peak above the memory in use when the call started, averaged over calls)
+and the largest of those.
+'''
+import os
+import sys
+import json
+import time
+import copy
+import random
+import argparse
+import tracemalloc
+
+# render offscreen
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ['PYGAME_HIDE_SUPPORT_PROMPT'] = 'hide'
+
+import numpy as np
+import torch
+
+from game import SnakeBasic, Direction
+from point import Point
+from model import Linear_QNet, QTrainer
+
+ARENAS = [(15, 15), (23, 23), (64, 64)]
+
+# seconds spent timing each case
+MIN_TIME = 1.
+
+def timeit(function, repeat: int = 10, warmup: int = 1):
+    '''
+    Runs function repeat times
+
+    returns: seconds per call
+    '''
+    for _ in range(warmup):
+        function()
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - start) / repeat
+
+def measure(function, min_time: float = None, alloc_calls: int = 1000):
+    '''
+    Calls function for at least min_time seconds, then alloc_calls more times under tracemalloc
+
+    returns: {'ops_per_sec', 'alloc_bytes_per_op', 'alloc_peak_bytes'}
+    '''
+    min_time = MIN_TIME if min_time is None else min_time
+    function()
+
+    calls = 0
+    number = 1
+    start = time.perf_counter()
+    while True:
+        for _ in range(number):
+            function()
+        calls += number
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        number *= 2
+
+    alloc_calls = max(1, min(alloc_calls, calls))
+    allocated = 0
+    largest = 0
+    tracemalloc.start()
+    for _ in range(alloc_calls):
+        tracemalloc.reset_peak()
+        before, _ = tracemalloc.get_traced_memory()
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+        allocated += peak - before
+        largest = max(largest, peak - before)
+    tracemalloc.stop()
+
+    return {
+        'ops_per_sec': calls / elapsed,
+        'alloc_bytes_per_op': allocated / alloc_calls,
+        'alloc_peak_bytes': largest,
+    }
+
+#region game helpers
+def _cycle(width: int, height: int):
+    '''
+    Closed path through the arena (the last row/column is skipped when needed to make it even):
+    down column 0, then serpentine through the other columns row by row back to the top
+
+    returns: list of (x, y)
+    '''
+    rows = height - height % 2
+    path = [(0, y) for y in range(rows)]
+    for row in range(rows - 1, -1, -1):
+        xs = range(1, width) if (rows - 1 - row) % 2 == 0 else range(width - 1, 0, -1)
+        path += [(x, row) for x in xs]
+    return path
+
+def _cycle_policy(width: int, height: int):
+    '''
+    returns: (path, {cell: action} following the path)
+    '''
+    path = _cycle(width, height)
+    policy = {}
+    for (x, y), (next_x, next_y) in zip(path, path[1:] + path[:1]):
+        direction = Direction.directions.index(Point(next_x - x, next_y - y))
+        policy[y * width + x] = direction
+    return (path, policy)
+
+def _lay_snake(game: SnakeBasic, cells):
+    '''
+    Replaces the snake with a body over cells (head first) and puts the apple somewhere free
+    '''
+    width = game.arena_dimensions[0]
+    game.reset()
+    for cell in game.snake_body:
+        game._vacate(cell)
+        game.free_cells.add(cell)
+    game.free_cells.add(game._apple_cell)
+
+    game.snake_body.clear()
+    for cell in cells:
+        game.snake_body.append(cell)
+        game._occupy(cell)
+        game.free_cells.remove(cell)
+
+    game._head_x, game._head_y = cells[0] % width, cells[0] // width
+    game._head_point = None
+    game.place_apple()
+    game._rehash()
+    game._seen = {game.hash}
+
+def _long_snake_game(arena, fill: float = .5, seed: int = 0):
+    '''
+    Game with a snake covering fill of the arena, laid out along the cycle so the cycle policy keeps it alive
+    '''
+    width, height = arena
+    path, policy = _cycle_policy(width, height)
+    length = int(len(path) * fill)
+
+    game = SnakeBasic(arena, seed)
+    cells = [y * width + x for x, y in reversed(path[:length])]
+    _lay_snake(game, cells)
+    game.LOOPED_VALUE = float('inf')
+    game.DETECT_LOOPS = False
+    return (game, policy, cells)
+#endregion
+
+#region benchmarks
+def bench_tick(arenas = ARENAS):
+    '''
+    SnakeBasic.tick with a random policy (short snakes, frequent resets)
+    and a scripted cycle policy on short and long snakes
+    '''
+    results = {}
+    for arena in arenas:
+        width, height = arena
+        rng = random.Random(0)
+
+        game = SnakeBasic(arena, 0)
+        moves = [rng.randint(0, 3) for _ in range(1 << 16)]
+        index = [0]
+        def random_tick():
+            index[0] = (index[0] + 1) & 0xffff
+            if game.tick(moves[index[0]])[1] or game.died:
+                game.reset()
+        results[f'random/{width}x{height}'] = measure(random_tick)
+
+        _, policy = _cycle_policy(width, height)
+        short = SnakeBasic(arena, 0)
+        short_cells = [(height - height % 2 - 1) * width]
+        _lay_snake(short, short_cells)
+        def short_tick():
+            if short.tick(policy[short.snake_body[0]])[1] or short.died:
+                _lay_snake(short, short_cells)
+        results[f'scripted_short/{width}x{height}'] = measure(short_tick)
+
+        long, policy, long_cells = _long_snake_game(arena)
+        def long_tick():
+            if long.tick(policy[long.snake_body[0]])[1] or long.died:
+                _lay_snake(long, long_cells)
+        results[f'scripted_long/{width}x{height}'] = measure(long_tick)
+
+    return results
+
+def bench_features(arenas = ARENAS):
+    '''
+    _get_basic_input_bin and _get_frame_matrix on a long snake, recomputed after every tick
+    '''
+    results = {}
+    for arena in arenas:
+        width, height = arena
+        game, policy, cells = _long_snake_game(arena)
+
+        def basic_input():
+            game._features = None
+            game._get_basic_input_bin()
+        results[f'basic_input_bin/{width}x{height}'] = measure(basic_input)
+        results[f'frame_matrix/{width}x{height}'] = measure(game._get_frame_matrix)
+        results[f'grid_observation/{width}x{height}'] = measure(game.get_grid_observation)
+
+    return results
+
+def bench_loops(arena = (23, 23), games: int = 100):
+    '''
+    Ticks loop detection saves a fixed greedy policy (an untrained Linear_QNet's best move that doesn't collide,
+    it circles a lot): the same games played with DETECT_LOOPS on and off,
+    the repeats must end the same games with the same scores as the counter
+    '''
+    from model import QInference
+
+    torch.manual_seed(0)
+    inference = QInference(Linear_QNet((24, 256, 128, 4)))
+    def policy(game):
+        q = inference.q_values(np.array(game._get_basic_input_bin(), dtype = np.float32))
+        safe = [not game.is_collision(game.snake_head_pos + direction) for direction in Direction.directions]
+        return int(np.where(safe, q, -np.inf).argmax())
+
+    runs = {}
+    for detect in (True, False):
+        game = SnakeBasic(arena, 0)
+        game.DETECT_LOOPS = detect
+        scores = []
+        ticks = 0
+        detected = 0
+        saved_max = 0
+        start = time.perf_counter()
+        for _ in range(games):
+            game.reset()
+            while True:
+                game.follow_policy(0)
+                reward, done, score = game.tick(policy(game))
+                ticks += 1
+                if done:
+                    break
+            scores.append(score)
+            detected += game.loop_detected
+            saved_max += game.loop_ticks_saved_max
+        runs[detect] = (scores, ticks, detected, saved_max, time.perf_counter() - start)
+
+    (scores, ticks, detected, saved_max, elapsed), (counter_scores, counter_ticks, _, _, counter_elapsed) = runs[True], runs[False]
+    return {
+        'loops_detected': detected,
+        'ticks_per_game/detect': ticks / games,
+        'ticks_per_game/counter': counter_ticks / games,
+        'ticks_saved_per_game': (counter_ticks - ticks) / games,
+        # what training logs, the same number under a fixed policy
+        'loop_ticks_saved_max_per_game': saved_max / games,
+        'games_per_sec/detect': games / elapsed,
+        'games_per_sec/counter': games / counter_elapsed,
+        'same_scores': scores == counter_scores,
+    }
+
+def bench_snapshot(arenas = ARENAS):
+    '''
+    SnakeBasic.snapshot / restore of a half-full arena and of a short snake against copy.deepcopy of the game
+    '''
+    results = {}
+    for arena in arenas:
+        width, height = arena
+        game, _, _ = _long_snake_game(arena)
+        other = SnakeBasic(arena, 1)
+        data = game.snapshot()
+
+        results[f'snapshot/{width}x{height}'] = measure(game.snapshot)
+        results[f'restore/{width}x{height}'] = measure(lambda: other.restore(data))
+        results[f'deepcopy/{width}x{height}'] = measure(lambda: copy.deepcopy(game), alloc_calls = 100)
+        results[f'snapshot_bytes/{width}x{height}'] = len(data)
+
+        # a fresh game's snake of a few blocks, restored over another short one
+        short = SnakeBasic(arena, 0)
+        for _ in range(3):
+            short.tick(1)
+        short_data = short.snapshot()
+        results[f'short_restore/{width}x{height}'] = measure(lambda: other.restore(short_data))
+        results[f'short_deepcopy/{width}x{height}'] = measure(lambda: copy.deepcopy(short), alloc_calls = 100)
+
+    return results
+
+def bench_planner(arena = (23, 23), depth: int = 4):
+    '''
+    planner.Planner searching depth moves ahead from a fresh game, the table cleared every time
+    '''
+    from model import QInference
+    from planner import Planner
+
+    game = SnakeBasic(arena, 0)
+    planner = Planner(QInference(Linear_QNet((24, 256, 128, 4))), budget = float('inf'), max_depth = depth, seed = 0)
+    def search():
+        planner.table.clear()
+        planner.search(game)
+    result = measure(search, alloc_calls = 10)
+    stats = planner.metrics()
+    result['nodes_per_sec'] = stats['planner_nodes_per_sec']
+    result['hit_rate'] = stats['planner_hit_rate']
+    return {f'search_depth_{depth}/{arena[0]}x{arena[1]}': result}
+
+def bench_agent():
+    '''
+    Agent.get_action (greedy) missing and hitting the Q cache, and Agent.train_long_memory with a full memory
+    '''
+    from main import Agent, MAX_MEMORY
+
+    agent = Agent()
+    agent.n_games = 1000
+    game = SnakeBasic((23, 23), 0)
+    state = agent.get_state(game)
+
+    # twice the cache's capacity of distinct states in turn, each one is evicted before it comes back
+    pool = np.unique(np.random.default_rng(0).integers(0, 1 << 24, 2 * agent.q_cache.capacity))
+    pool_states = SnakeBasic.unpack_states(pool, 24)
+    index = [0]
+    def miss():
+        index[0] = (index[0] + 1) % len(pool_states)
+        agent.get_action(pool_states[index[0]], game)
+
+    results = {'get_action/miss': measure(miss)}
+    results['get_action/hit'] = measure(lambda: agent.get_action(state, game))
+
+    states = np.random.randint(0, 2, (MAX_MEMORY, 24))
+    agent.memory.push_many(states, np.random.randint(0, 4, MAX_MEMORY), np.random.choice([10, -10, -.01], MAX_MEMORY),
+                           np.roll(states, 1, axis = 0), np.random.rand(MAX_MEMORY) < .05)
+    results['train_long_memory/100k'] = measure(agent.train_long_memory, alloc_calls = 10)
+
+    return results
+
+def bench_inference(batch_size: int = 256, samples: int = 10_000):
+    '''
+    QInference against the torch forward pass: latency per action and agreement on random states
+    '''
+    from model import QInference
+
+    model = Linear_QNet((24, 256, 128, 4))
+    inference = QInference(model)
+    state = np.random.randint(0, 2, 24)
+    batch = np.random.randint(0, 2, (batch_size, 24))
+
+    def torch_act():
+        return torch.argmax(model(torch.tensor(state, dtype=torch.float))).item()
+    def torch_act_no_grad():
+        with torch.inference_mode():
+            return torch.argmax(model(torch.from_numpy(state.astype(np.float32)))).item()
+
+    states = np.random.randint(0, 2, (samples, 24))
+    with torch.no_grad():
+        reference = model(torch.tensor(states, dtype=torch.float)).numpy()
+    q = inference.q_values(states)
+
+    return {
+        'torch_single': measure(torch_act),
+        'torch_inference_mode_single': measure(torch_act_no_grad),
+        'numpy_single': measure(lambda: inference.act(state)),
+        f'numpy_batch_{batch_size}': measure(lambda: inference.act(batch)),
+        'argmax_agreement': float((q.argmax(axis = 1) == reference.argmax(axis = 1)).mean()),
+        'max_q_diff': float(np.abs(q - reference).max()),
+    }
+
+def bench_train_step(batch_sizes = (1, 1000)):
+    '''
+    QTrainer.train_step on random batches
+    '''
+    results = {}
+    for batch_size in batch_sizes:
+        trainer = QTrainer(Linear_QNet((24, 256, 128, 4)), lr=0.001, gamma=.9)
+        batch = _random_batch(batch_size, one_hot = False)
+        if batch_size == 1:
+            batch = tuple(x[0] for x in batch)
+        results[f'batch_{batch_size}'] = measure(lambda: trainer.train_step(*batch), alloc_calls = 20)
+    return results
+
+def bench_draw(arenas = ARENAS, cell_size: int = 30):
+    '''
+    SnakeWindowed.draw of a long snake to an offscreen surface (SDL dummy video driver),
+    a full repaint and a tick followed by the incremental (dirty rects) draw
+    '''
+    import pygame
+    from game import SnakeWindowed
+
+    results = {}
+    pygame.display.set_mode((1, 1))
+    for arena in arenas:
+        width, height = arena
+        game = SnakeWindowed(arena, cell_size, 0)
+        _, policy = _cycle_policy(width, height)
+        path = _cycle(width, height)
+        cells = [y * width + x for x, y in reversed(path[:len(path) // 2])]
+        _lay_snake(game, cells)
+        game.LOOPED_VALUE = float('inf')
+        game.DETECT_LOOPS = False
+        target = pygame.Surface((game.width, game.height))
+
+        def full():
+            game.redraw()
+            game.draw(target)
+        results[f'full/{width}x{height}'] = measure(full, alloc_calls = 50)
+
+        def tick_draw():
+            if game.tick(policy[game.snake_body[0]])[1] or game.died:
+                _lay_snake(game, cells)
+            game.draw(target)
+        results[f'tick_incremental/{width}x{height}'] = measure(tick_draw, alloc_calls = 50)
+
+    return results
+
+def bench_viewer(games: int = 16, arena = (23, 23), cell_size: int = 6):
+    '''
+    One frame of games long snakes: viewer.TiledViewer (numpy + surfarray) vs SnakeWindowed full repaints
+    '''
+    import pygame
+    from game import SnakeWindowed
+    from viewer import TiledViewer
+
+    pygame.display.set_mode((1, 1))
+    width, height = arena
+    path = _cycle(width, height)
+    boards = []
+    for index in range(games):
+        game = SnakeWindowed(arena, cell_size, index)
+        _lay_snake(game, [y * width + x for x, y in reversed(path[:len(path) * (index + 1) // (games + 1)])])
+        boards.append(game)
+
+    viewer = TiledViewer(games, arena, cell_size, max_fps = None, surface = pygame.Surface((2000, 2000)))
+    target = pygame.Surface((boards[0].width, boards[0].height))
+    def windowed():
+        for game in boards:
+            game.redraw()
+            game.draw(target)
+
+    return {
+        f'tiled/{games}x{width}x{height}': measure(lambda: viewer.show(boards), alloc_calls = 50),
+        f'windowed/{games}x{width}x{height}': measure(windowed, alloc_calls = 20),
+    }
+
+def bench_trajectory(stored: int = 1_000_000, batch_size: int = 1000, chunk: int = 256):
+    '''
+    trajectory_store on a temp folder: recording (transitions/sec one by one and in chunks)
+    and replay batches sampled from stored memory-mapped transitions
+    '''
+    import tempfile
+    from trajectory_store import TrajectoryWriter, TrajectoryStore
+
+    results = {}
+    states = np.random.randint(0, 2, (chunk, 24))
+    next_states = np.random.randint(0, 2, (chunk, 24))
+    actions = np.random.randint(0, 4, chunk)
+    rewards = np.random.choice([10, -10, 0], chunk).astype(np.float32)
+    dones = np.random.rand(chunk) < .02
+
+    with tempfile.TemporaryDirectory() as folder:
+        with TrajectoryWriter(os.path.join(folder, 'push')) as writer:
+            state, next_state = list(states[0]), list(next_states[0])
+            results['push'] = measure(lambda: writer.push(state, 1, -.01, next_state, False))
+
+        with TrajectoryWriter(os.path.join(folder, 'many')) as writer:
+            results[f'push_many/{chunk}'] = measure(lambda: writer.push_many(states, actions, rewards, next_states, dones), alloc_calls = 100)
+            results[f'push_many/{chunk}']['transitions_per_sec'] = results[f'push_many/{chunk}']['ops_per_sec'] * chunk
+
+            while len(writer) < stored:
+                writer.push_many(states, actions, rewards, next_states, dones)
+
+        store = TrajectoryStore(os.path.join(folder, 'many'), 0)
+        results['stored'] = len(store)
+        results[f'sample/{batch_size}'] = measure(lambda: store.sample(batch_size), alloc_calls = 100)
+        results[f'sample/{batch_size}']['transitions_per_sec'] = results[f'sample/{batch_size}']['ops_per_sec'] * batch_size
+
+        # the same sampling from the in-memory replay buffer, for reference
+        from replay_buffer import ReplayBuffer
+        memory = ReplayBuffer(100_000, 24, packed = True)
+        memory.push_many(np.resize(states, (100_000, 24)), np.resize(actions, 100_000), np.resize(rewards, 100_000),
+                         np.resize(next_states, (100_000, 24)), np.resize(dones, 100_000))
+        results[f'replay_buffer_sample/{batch_size}'] = measure(lambda: memory.sample(batch_size), alloc_calls = 100)
+
+    return results
+
+def _random_batch(batch_size: int, one_hot: bool = True):
+    states = np.random.randint(0, 2, (batch_size, 24))
+    next_states = np.random.randint(0, 2, (batch_size, 24))
+    moves = np.random.randint(0, 4, batch_size)
+    actions = np.eye(4, dtype=int)[moves] if one_hot else moves
+    rewards = np.random.choice([10, -10, -.01, 0], batch_size)
+    dones = np.random.rand(batch_size) < .1
+    return (states, actions, rewards, next_states, dones)
+
+def _train_step_loop(trainer: QTrainer, state, action, reward, next_state, done):
+    '''
+    QTrainer.train_step as it used to be: one forward pass per sample
+    '''
+    state = torch.tensor(state, dtype=torch.float)
+    next_state = torch.tensor(next_state, dtype=torch.float)
+    action = torch.tensor(action, dtype=torch.long)
+    reward = torch.tensor(reward, dtype=torch.float)
+
+    pred = trainer.model(state)
+    target = pred.clone()
+    for idx in range(len(done)):
+        Q_new = reward[idx]
+        if not done[idx]:
+            Q_new = reward[idx] + trainer.gamma * torch.max(trainer.model(next_state[idx]))
+
+        target[idx][torch.argmax(action[idx]).item()] = Q_new
+
+    trainer.optimizer.zero_grad()
+    loss = trainer.criterion(target, pred)
+    loss.backward()
+    trainer.optimizer.step()
+
+def bench_train_step_vs_loop(batch_size: int = 1000, repeat: int = 20):
+    '''
+    Batched QTrainer.train_step against the old per-sample loop, checks both give the same weights
+    '''
+    batch = _random_batch(batch_size)
+
+    model = Linear_QNet((24, 256, 128, 4))
+    reference = copy.deepcopy(model)
+    trainer = QTrainer(model, lr=0.001, gamma=.9)
+    reference_trainer = QTrainer(reference, lr=0.001, gamma=.9)
+
+    trainer.train_step(*batch)
+    _train_step_loop(reference_trainer, *batch)
+    max_diff = max((a - b).abs().max().item() for a, b in zip(model.parameters(), reference.parameters()))
+
+    batched = timeit(lambda: trainer.train_step(*batch), repeat)
+    loop = timeit(lambda: _train_step_loop(reference_trainer, *batch), repeat)
+
+    return {
+        'batch_size': batch_size,
+        'batched_steps_per_sec': 1 / batched,
+        'loop_steps_per_sec': 1 / loop,
+        'speedup': loop / batched,
+        'max_weight_diff': max_diff,
+    }
+#endregion
+
+BENCHMARKS = {
+    'tick': bench_tick,
+    'features': bench_features,
+    'agent': bench_agent,
+    'train_step': bench_train_step,
+    'inference': bench_inference,
+    'draw': bench_draw,
+    'viewer': bench_viewer,
+    'trajectory': bench_trajectory,
+    'snapshot': bench_snapshot,
+    'loops': bench_loops,
+    'planner': bench_planner,
+    'train_step_vs_loop': bench_train_step_vs_loop,
+}
+
+def _print(results, baseline = None):
+    for name, cases in results.items():
+        print(f'{name}:')
+        for case, value in cases.items():
+            if isinstance(value, dict) and 'ops_per_sec' in value:
+                line = f'\t{case:<28} {value["ops_per_sec"]:>14,.1f} ops/s {value["alloc_bytes_per_op"]:>11,.0f} B/op {value["alloc_peak_bytes"]:>11,} B peak'
+                old = (baseline or {}).get(name, {}).get(case)
+                if old:
+                    line += f'   x{value["ops_per_sec"] / old["ops_per_sec"]:.2f} vs baseline'
+                print(line)
+            else:
+                print(f'\t{case} = {value:.6g}' if isinstance(value, float) else f'\t{case} = {value}')
+
+def main(argv = None):
+    global MIN_TIME
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('names', nargs = '*', help = f'benchmarks to run, all of {", ".join(BENCHMARKS)} by default')
+    parser.add_argument('--output', help = 'save results as json')
+    parser.add_argument('--compare', help = 'json of an earlier run to compare ops/sec against')
+    parser.add_argument('--quick', action = 'store_true', help = 'time each case for .2s instead of 1s')
+    args = parser.parse_args(argv)
+
+    if args.quick:
+        MIN_TIME = .2
+
+    random.seed(0)
+    np.random.seed(0)
+    torch.manual_seed(0)
+
+    results = {}
+    for name in args.names or BENCHMARKS:
+        results[name] = BENCHMARKS[name]()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)['results']
+    _print(results, baseline)
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump({
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'python': sys.version.split()[0],
+                'torch': torch.__version__,
+                'numpy': np.__version__,
+                'results': results,
+            }, file, indent = 2)
+
+    return results
+
+if __name__ == '__main__':
+    # assets are loaded relative to the repo
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    main()
@@ -0,0 +1,167 @@
+'''
+Full training checkpoints: network with its architecture, QTrainer optimizer state, agent counters
+and optionally the replay memory, written from a background thread with atomic renames.
+'''
+import os
+import glob
+import copy
+import shutil
+import threading
+import queue
+
+import numpy as np
+import torch
+
+from replay_buffer import PrioritizedReplayBuffer
+
+MEMORY_FIELDS = ('states', 'actions', 'rewards', 'next_states', 'dones')
+
+class Checkpointer:
+    '''
+    save() snapshots everything in the calling thread (tensor and array copies)
+    and leaves serialization and disk writes to a worker thread.
+    '''
+    def __init__(self, folder: str = './model'):
+        self.folder = folder
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target = self._run, daemon = True)
+        self._thread.start()
+
+    def save(self, agent, record: int, file_name: str = 'checkpoint.pth', memory: bool = False):
+        self._queue.put((file_name, snapshot(agent, record, memory)))
+
+    def wait(self):
+        '''
+        Blocks until every queued checkpoint is on disk
+        '''
+        self._queue.join()
+
+    def close(self):
+        self.wait()
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                self._queue.task_done()
+                break
+            try:
+                write(os.path.join(self.folder, job[0]), job[1])
+            except Exception as error:
+                print(f'checkpoint {job[0]} failed: {error}')
+            finally:
+                self._queue.task_done()
+
+def snapshot(agent, record: int, memory: bool = False):
+    '''
+    Copies of everything needed to resume training, safe to write while training goes on
+    '''
+    state = {
+        'architecture': tuple(agent.model.architecture),
+        'model': {key: value.detach().clone() for key, value in agent.model.state_dict().items()},
+        'optimizer': copy.deepcopy(agent.trainer.optimizer.state_dict()),
+        'lr': agent.trainer.lr,
+        'gamma': agent.trainer.gamma,
+        'n_games': agent.n_games,
+        'total_score': agent.total_score,
+        'epsilon': agent.epsilon,
+        'epsilon_games': agent.epsilon_games,
+        'batch_size': agent.batch_size,
+        'record': record,
+        'prioritized': agent.prioritized,
+        'memory': None,
+    }
+
+    if memory:
+        buffer = agent.memory
+        arrays = {field: getattr(buffer, field)[:buffer.size].copy() for field in MEMORY_FIELDS}
+        meta = {'capacity': buffer.capacity, 'index': buffer.index, 'size': buffer.size}
+        if isinstance(buffer, PrioritizedReplayBuffer):
+            arrays['priorities'] = buffer.priorities.tree.copy()
+            # plain floats, torch.load(weights_only) refuses numpy scalars
+            meta.update(max_priority = float(buffer.max_priority), beta = float(buffer.beta))
+        state['memory'] = (meta, arrays)
+
+    return state
+
+def write(path: str, state):
+    '''
+    Writes a snapshot to path through a temp file and an atomic rename,
+    the replay memory goes next to it as .npy files in a folder named after the game count
+    '''
+    state = dict(state)
+
+    if state['memory'] is not None:
+        meta, arrays = state['memory']
+        folder = f'{path}.memory.{state["n_games"]}'
+        temp = folder + '.tmp'
+        shutil.rmtree(temp, ignore_errors = True)
+        os.makedirs(temp)
+        for name, array in arrays.items():
+            np.save(os.path.join(temp, name + '.npy'), array)
+        shutil.rmtree(folder, ignore_errors = True)
+        os.replace(temp, folder)
+        state['memory'] = dict(meta, folder = os.path.basename(folder))
+
+    torch.save(state, path + '.tmp')
+    os.replace(path + '.tmp', path)
+
+    # memory folders the checkpoint no longer points to
+    current = state['memory']['folder'] if state['memory'] else None
+    for folder in glob.glob(glob.escape(path) + '.memory.*'):
+        if os.path.basename(folder) != current and not folder.endswith('.tmp'):
+            shutil.rmtree(folder, ignore_errors = True)
+
+def load_memory(buffer, path: str, meta):
+    '''
+    Fills a replay buffer from the memory-mapped arrays of a checkpoint
+    '''
+    folder = os.path.join(os.path.dirname(path), meta['folder'])
+    size = min(meta['size'], buffer.capacity)
+
+    for field in MEMORY_FIELDS:
+        array = np.load(os.path.join(folder, field + '.npy'), mmap_mode = 'r')
+        getattr(buffer, field)[:size] = array[:size]
+    buffer.size = size
+    buffer.index = meta['index'] % buffer.capacity if meta['capacity'] == buffer.capacity else size % buffer.capacity
+
+    if isinstance(buffer, PrioritizedReplayBuffer):
+        priorities = os.path.join(folder, 'priorities.npy')
+        if os.path.exists(priorities) and meta['capacity'] == buffer.capacity:
+            buffer.priorities.tree[:] = np.load(priorities, mmap_mode = 'r')
+            buffer.max_priority = meta['max_priority']
+            buffer.beta = meta['beta']
+        else:
+            buffer.priorities.update(np.arange(buffer.size), np.full(buffer.size, buffer.max_priority ** buffer.alpha))
+
+def resume(path: str = './model/checkpoint.pth'):
+    '''
+    Rebuilds the agent saved at path: network, optimizer, counters and replay memory if it was saved
+
+    returns: (agent, record)
+    '''
+    from main import Agent
+
+    state = torch.load(path)
+    agent = Agent(state['prioritized'], state['architecture'])
+    agent.epsilon_games = state.get('epsilon_games', agent.epsilon_games)
+    agent.batch_size = state.get('batch_size', agent.batch_size)
+    agent.model.load_state_dict(state['model'])
+    agent.trainer.optimizer.load_state_dict(state['optimizer'])
+    agent.inference.refresh()
+    agent.trainer.lr = state['lr']
+    agent.trainer.gamma = agent.gamma = state['gamma']
+
+    agent.n_games = state['n_games']
+    agent.total_score = state['total_score']
+    agent.epsilon = state['epsilon']
+
+    if state['memory'] is not None:
+        load_memory(agent.memory, path, state['memory'])
+
+    return (agent, state['record'])
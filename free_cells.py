@@ -0,0 +1,88 @@
+import numpy as np
+
+class FreeCells:
+    '''
+    Set of free arena cells (flat indices y * width + x) with O(1) add and remove,
+    and a random pick that is O(1) while free cells aren't rare, O(sqrt(cells)) at worst.
+
+    cells holds the free cells packed at the front, position maps a cell to its slot in cells (-1 if taken).
+    block_counts holds the free cells of every block of block_size consecutive cells, to find the k-th free cell.
+    '''
+    def __init__(self, count: int):
+        self.cells = list(range(count))
+        self.position = list(range(count))
+
+        self.block_size = max(1, int(np.ceil(np.sqrt(count))))
+        self.block_counts = [min(self.block_size, count - start) for start in range(0, count, self.block_size)]
+
+    def __len__(self):
+        return len(self.cells)
+
+    def __contains__(self, cell: int):
+        return self.position[cell] != -1
+
+    def __iter__(self):
+        return iter(self.cells)
+
+    def add(self, cell: int):
+        if self.position[cell] != -1:
+            return
+        self.position[cell] = len(self.cells)
+        self.cells.append(cell)
+        self.block_counts[cell // self.block_size] += 1
+
+    def remove(self, cell: int):
+        index = self.position[cell]
+        if index == -1:
+            raise KeyError(cell)
+
+        # swap with the last cell and pop it
+        last = self.cells.pop()
+        if last != cell:
+            self.cells[index] = last
+            self.position[last] = index
+        self.position[cell] = -1
+        self.block_counts[cell // self.block_size] -= 1
+
+    def assign(self, cells):
+        '''
+        Makes exactly cells free, cells is an int numpy array of distinct cells
+        '''
+        position = np.full(len(self.position), -1, dtype = np.int64)
+        position[cells] = np.arange(len(cells))
+        self.cells = cells.tolist()
+        self.position = position.tolist()
+        self.block_counts = np.bincount(cells // self.block_size, minlength = len(self.block_counts)).tolist()
+
+    def nth(self, index: int):
+        '''
+        returns: the index-th smallest free cell, walking the block counts and then one block
+        '''
+        block = 0
+        for count in self.block_counts:
+            if index < count:
+                break
+            index -= count
+            block += 1
+
+        position = self.position
+        for cell in range(block * self.block_size, min((block + 1) * self.block_size, len(position))):
+            if position[cell] != -1:
+                if not index:
+                    return cell
+                index -= 1
+        raise IndexError(index)
+
+    def sample(self, rng, tries: int = 8):
+        '''
+        Uniform pick that depends only on which cells are free and on rng, not on the order cells were freed in:
+        random cells of the whole arena until a free one, a random rank among the free cells once tries run out
+        '''
+        if not self.cells:
+            raise IndexError('no free cells')
+        count = len(self.position)
+        for _ in range(tries):
+            cell = rng.randrange(count)
+            if self.position[cell] != -1:
+                return cell
+        return self.nth(rng.randrange(len(self.cells)))
@@ -1,9 +1,60 @@
-from random import choice
+from random import Random
 from point import Point
+from free_cells import FreeCells
+from collections import deque
+import struct
+
+import numpy as np
 
 import os
 os.environ['PYGAME_HIDE_SUPPORT_PROMPT'] = "hide"
 
+class GameRandom:
+    '''
+    Per game rng (splitmix64), its whole state is one 64-bit int so a snapshot carries it for free.
+    Takes any seed Random takes, None seeds from the os.
+    '''
+    __slots__ = ('state', )
+    MASK = (1 << 64) - 1
+    
+    def __init__(self, seed = None):
+        self.state = Random(seed).getrandbits(64)
+    
+    def next(self):
+        '''
+        returns: next 64-bit value
+        '''
+        self.state = z = (self.state + 0x9E3779B97F4A7C15) & GameRandom.MASK
+        z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & GameRandom.MASK
+        z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & GameRandom.MASK
+        return z ^ (z >> 31)
+    
+    def randrange(self, stop: int):
+        if stop <= 0:
+            raise ValueError('empty range for randrange()')
+        return self.next() % stop
+
+class ZobristKeys:
+    '''
+    Random 63-bit keys per cell for the body, the head, the tail and the apple, and per direction (by (x, y)).
+    Fixed per arena size, so hashes of games compare across games and processes.
+    '''
+    _tables = {}
+    
+    def __init__(self, cells: int):
+        rng = np.random.default_rng(cells)
+        keys = rng.integers(0, 1 << 63, (4, cells), dtype = np.int64)
+        self.body_array = keys[0]
+        self.body, self.head, self.tail, self.apple = (row.tolist() for row in keys)
+        self.direction = dict(zip([(d.x, d.y) for d in Direction.directions], rng.integers(0, 1 << 63, 4, dtype = np.int64).tolist()))
+    
+    @staticmethod
+    def of(cells: int):
+        keys = ZobristKeys._tables.get(cells)
+        if keys is None:
+            keys = ZobristKeys._tables[cells] = ZobristKeys(cells)
+        return keys
+
 class SnakeBasic:
     '''
     Contains basic implementation of snake game
@@ -12,30 +63,76 @@ class SnakeBasic:
     REWARD_GAME_OVER = -10
     REWARD_LIVED = -.01
     REWARD_LOOPED = 0
+    
+    # snapshot(): rng state, score, looped, apple cell, direction index, died - then the body cells
+    SNAPSHOT_HEADER = struct.Struct('<QIIIB?')
+    # restore() moves snakes shorter than this (old + new length) cell by cell instead of rebuilding the board
+    RESTORE_CELL_BY_CELL = 64
+    
+    # end a game as looped as soon as its hash repeats since the last apple and the last forget_positions()
+    # (moves off the policy or a policy update), remembering up to LOOP_HASHES of them - the LOOPED_VALUE counter covers the rest
+    DETECT_LOOPS = True
+    LOOP_HASHES = 4096
 
-    def __init__(self, arena_size: tuple[int, int] = (15, 15)):
+    def __init__(self, arena_size: tuple[int, int] = (15, 15), seed = None):
         self.arena_dimensions = arena_size
         
+        # per game rng, seed it for reproducible apples
+        self.rng = GameRandom(seed)
+        
+        # type of body cells in snapshots
+        if arena_size[0] * arena_size[1] <= 1 << 16:
+            self._cell_format, self._cell_dtype = 'H', np.dtype('<u2')
+        else:
+            self._cell_format, self._cell_dtype = 'I', np.dtype('<u4')
+        
+        # Direction.directions as cell index deltas
+        self.direction_deltas = Direction.deltas(arena_size[0])
+        
+        # numpy board planes, allocated on first get_grid_observation
+        self._planes = None
+        
+        # Zobrist hash of body cells, head, tail, apple and direction, kept up to date by tick
+        self._zobrist = ZobristKeys.of(arena_size[0] * arena_size[1])
+        self.hash = 0
+        self._apple_cell = 0
+        
         # set deafult
         self.reset()
         
     def reset(self):
-        # x, y 
-        self.free_spaces = [Point(x, y) for y in range(0, self.arena_dimensions[1]) for x in range(0, self.arena_dimensions[0])]
+        # free cells as flat indices y * width + x
+        self.free_cells = FreeCells(self.arena_dimensions[0] * self.arena_dimensions[1])
         
         # set snake default direction
         self.snake_direction = Direction.UP
         
         # center snake's position
-        self.snake_head_pos = Point(self.arena_dimensions[0]//2, self.arena_dimensions[1]//2)
-        self.free_spaces.remove(self.snake_head_pos)
+        self._head_x, self._head_y = self.arena_dimensions[0]//2, self.arena_dimensions[1]//2
+        self._head_point = None
+        
+        # snake's body as cell indices, head first
+        self.snake_body = deque([self._head_y * self.arena_dimensions[0] + self._head_x])
+        
+        # occupancy grid, 1 where the snake is, and the same grid stored column by column
+        self.grid = bytearray(self.arena_dimensions[0] * self.arena_dimensions[1])
+        self.grid_columns = bytearray(self.arena_dimensions[0] * self.arena_dimensions[1])
+        
+        # body blocks in every row and column
+        self.row_counts = [0] * self.arena_dimensions[1]
+        self.column_counts = [0] * self.arena_dimensions[0]
         
-        # add head position to body position
-        self.snake_body_pos = [self.snake_head_pos.copy()]
+        if self._planes is not None:
+            self._planes.fill(0)
+            self._planes[1, self._head_y, self._head_x] = 1
         
         # allocate area with snake's blocks
-        for pos in self.snake_body_pos[1:]:
-            self.free_spaces.remove(pos)
+        for cell in self.snake_body:
+            self._occupy(cell)
+            self.free_cells.remove(cell)
+        
+        # features cache, see _get_basic_input_bin
+        self._features = None
         
         # apple <3 
         self.place_apple()
@@ -47,10 +144,164 @@ class SnakeBasic:
         self.died = False
         self.score = 0
         
+        self._rehash()
+        
+        # hashes seen since the last apple under policy version _policy_version, whether a repeat ended the game
+        # and the ticks the counter could still have run: exact under a fixed policy, an upper bound while it trains
+        self._seen = {self.hash}
+        self._policy_version = None
+        self.loop_detected = False
+        self.loop_ticks_saved_max = 0
+        
+    @property
+    def free_spaces(self):
+        '''
+        Free cells as points (read only)
+        '''
+        return [Point(cell % self.arena_dimensions[0], cell // self.arena_dimensions[0]) for cell in self.free_cells]
+    
+    @property
+    def snake_head_pos(self):
+        '''
+        Snake's head as a point (read only), made only when asked for
+        '''
+        if self._head_point is None:
+            self._head_point = Point(self._head_x, self._head_y)
+        return self._head_point
+    
+    @property
+    def snake_body_pos(self):
+        '''
+        Snake's body as points, head first (read only)
+        '''
+        return [Point(cell % self.arena_dimensions[0], cell // self.arena_dimensions[0]) for cell in self.snake_body]
+    
+    def snapshot(self):
+        '''
+        The whole game as bytes: SNAPSHOT_HEADER, then the body cells head first
+        (little-endian uint16, uint32 on arenas of over 65536 cells). Board, free cells and caches are derived from those.
+        '''
+        return struct.pack(f'{SnakeBasic.SNAPSHOT_HEADER.format}{len(self.snake_body)}{self._cell_format}',
+                           self.rng.state, self.score, self.looped, self._apple_cell,
+                           Direction.directions.index(self.snake_direction), self.died, *self.snake_body)
+    
+    def restore(self, snapshot):
+        '''
+        Puts the game into the state snapshot() returned, of this game or another one with the same arena size.
+        The restored game plays on exactly like the one snapshotted (same apples for the same moves),
+        except that loop detection only remembers positions from the restored one on.
+        '''
+        header = SnakeBasic.SNAPSHOT_HEADER
+        rng_state, score, looped, apple_cell, direction, died = header.unpack_from(snapshot)
+        body = np.frombuffer(snapshot, dtype = self._cell_dtype, offset = header.size)
+        width, height = self.arena_dimensions
+        
+        if len(self.snake_body) + len(body) < SnakeBasic.RESTORE_CELL_BY_CELL:
+            # short snakes: take the current one and the apple off the board and put the new one on
+            for cell in self.snake_body:
+                self._vacate(cell)
+                self.free_cells.add(cell)
+            self.free_cells.add(self._apple_cell)
+            
+            self.snake_body = deque(body.tolist())
+            for cell in self.snake_body:
+                self._occupy(cell)
+                self.free_cells.remove(cell)
+            self.free_cells.remove(apple_cell)
+        else:
+            # long ones: whole board rebuilt with numpy
+            body = body.astype(np.int64)
+            grid = np.zeros(width * height, dtype = np.uint8)
+            grid[body] = 1
+            self.grid[:] = grid.tobytes()
+            self.grid_columns[:] = grid.reshape(height, width).T.tobytes()
+            self.row_counts = np.bincount(body // width, minlength = height).tolist()
+            self.column_counts = np.bincount(body % width, minlength = width).tolist()
+            grid[apple_cell] = 1
+            self.free_cells.assign(np.flatnonzero(grid == 0))
+            self.snake_body = deque(body.tolist())
+        
+        head = self.snake_body[0]
+        self._head_x, self._head_y = head % width, head // width
+        self._head_point = None
+        self.snake_direction = Direction.directions[direction]
+        self.apple_pos = Point(apple_cell % width, apple_cell // width)
+        self._apple_cell = apple_cell
+        
+        self.rng.state = rng_state
+        self.score = score
+        self.looped = looped
+        self.died = died
+        
+        self._features = None
+        if self._planes is not None:
+            self._build_planes()
+        self._rehash()
+        self._seen = {self.hash}
+        self._policy_version = None
+        self.loop_detected = False
+        self.loop_ticks_saved_max = 0
+    
+    def forget_positions(self):
+        '''
+        Call before a move that doesn't come from the policy (an exploring random move):
+        a repeated position is only a closed loop if every move since its first visit was the policy's.
+        '''
+        self._seen.clear()
+        self._seen.add(self.hash)
+    
+    def follow_policy(self, version):
+        '''
+        Call before a move of the policy with its version (the trainer's step count, ...):
+        positions seen under another version are forgotten, the updated policy may leave the loop.
+        '''
+        if version != self._policy_version:
+            self._policy_version = version
+            self.forget_positions()
+    
+    def _rehash(self):
+        '''
+        Zobrist hash computed from scratch, tick updates it with a few xors
+        '''
+        keys = self._zobrist
+        body = np.fromiter(self.snake_body, dtype = np.int64, count = len(self.snake_body))
+        self.hash = (int(np.bitwise_xor.reduce(keys.body_array[body])) ^ keys.head[self.snake_body[0]] ^
+                     keys.tail[self.snake_body[-1]] ^ keys.apple[self._apple_cell] ^ keys.direction[self.snake_direction.x, self.snake_direction.y])
+    
+    def _cell(self, point: Point):
+        return point.y * self.arena_dimensions[0] + point.x
+    
+    def _occupy(self, cell: int):
+        x, y = cell % self.arena_dimensions[0], cell // self.arena_dimensions[0]
+        self.grid[cell] = 1
+        self.grid_columns[x * self.arena_dimensions[1] + y] = 1
+        self.row_counts[y] += 1
+        self.column_counts[x] += 1
+        self.hash ^= self._zobrist.body[cell]
+        if self._planes is not None:
+            self._planes[0, y, x] = 1
+    
+    def _vacate(self, cell: int):
+        x, y = cell % self.arena_dimensions[0], cell // self.arena_dimensions[0]
+        self.grid[cell] = 0
+        self.grid_columns[x * self.arena_dimensions[1] + y] = 0
+        self.row_counts[y] -= 1
+        self.column_counts[x] -= 1
+        self.hash ^= self._zobrist.body[cell]
+        if self._planes is not None:
+            self._planes[0, y, x] = 0
+    
     def place_apple(self):
         # random pick random apple position    
-        self.apple_pos = choice(self.free_spaces)
-        self.free_spaces.remove(self.apple_pos)
+        cell = self.free_cells.sample(self.rng)
+        self.free_cells.remove(cell)
+        if self._planes is not None:
+            self._planes[2, self.apple_pos.y, self.apple_pos.x] = 0
+            self._planes[2, cell // self.arena_dimensions[0], cell % self.arena_dimensions[0]] = 1
+        self.apple_pos = Point(cell % self.arena_dimensions[0], cell // self.arena_dimensions[0])
+        self.hash ^= self._zobrist.apple[self._apple_cell] ^ self._zobrist.apple[cell]
+        self._apple_cell = cell
+        self._features = None
         
     def tick(self, _input, **kwargs):
         '''
@@ -63,52 +314,82 @@ class SnakeBasic:
         if self.died:
             return (0, self.died, self.score)
          
+        direction = self.snake_direction
+        
         # parse the int input
         if(isinstance(_input, int)):
             self.snake_direction = Direction.directions[_input]
+            delta = self.direction_deltas[_input]
         elif(isinstance(_input, Point)):
             self.snake_direction = _input
+            delta = _input.y * self.arena_dimensions[0] + _input.x
         else:
             raise 'Wrong input type!'
+        
+        # features are stale from now on
+        self._features = None
+        keys = self._zobrist
+        if direction is not self.snake_direction:
+            self.hash ^= keys.direction[direction.x, direction.y] ^ keys.direction[self.snake_direction.x, self.snake_direction.y]
+        
+        x = self._head_x + self.snake_direction.x
+        y = self._head_y + self.snake_direction.y
             
         # check if snake out of border
         # or ran into itself
-        if self.is_collision(self.snake_head_pos + self.snake_direction):
+        if self._is_collision_xy(x, y):
             self.died = True
             return (SnakeBasic.REWARD_GAME_OVER, self.died, self.score)
 
         # move snake's head 
-        self.snake_head_pos += self.snake_direction
+        if self._planes is not None:
+            self._planes[1, self._head_y, self._head_x] = 0
+            self._planes[1, y, x] = 1
+        self._head_x, self._head_y = x, y
+        self._head_point = None
+        head = self.snake_body[0] + delta
+        self.hash ^= keys.head[self.snake_body[0]] ^ keys.head[head]
         
         # check if ate an apple
-        if self.snake_head_pos == self.apple_pos:
+        if head == self._apple_cell:
             # add score
             self.score += 1
             
             # add a block to the snake 
-            self.snake_body_pos.insert(0, self.snake_head_pos)
+            self.snake_body.appendleft(head)
+            self._occupy(head)
             
             # pick apple random position and del it from free spaces
             self.place_apple()
             
             self.looped = 0
+            self._seen.clear()
+            self._seen.add(self.hash)
             return (SnakeBasic.REWARD_FOOD_EATEN, False, self.score)
         else:
-            # add tail position to free spaces 
-            self.free_spaces.append(self.snake_body_pos[-1])
-            
-            # remove head pos from free spaces
-            self.free_spaces.remove(self.snake_head_pos)
+            # pop the tail and add it to free spaces 
+            tail = self.snake_body.pop()
+            self._vacate(tail)
+            self.free_cells.add(tail)
             
-            # move the rest of the snake's body
-            for i in range(len(self.snake_body_pos) - 1, 0, -1):
-                # move block
-                self.snake_body_pos[i] = self.snake_body_pos[i-1]                    
-            # move head
-            self.snake_body_pos[0] = self.snake_head_pos
+            # push the head and remove it from free spaces
+            self.snake_body.appendleft(head)
+            self._occupy(head)
+            self.free_cells.remove(head)
+            self.hash ^= keys.tail[tail] ^ keys.tail[self.snake_body[-1]]
         
         # anti looping system
         self.looped +=1
+        if self.DETECT_LOOPS:
+            # same snake, apple and direction as before, a cycle closed
+            if self.hash in self._seen:
+                self.died = True
+                self.loop_detected = True
+                if self.LOOPED_VALUE < float('inf'):
+                    self.loop_ticks_saved_max = int(self.LOOPED_VALUE - self.looped) + 1
+                return (SnakeBasic.REWARD_LOOPED, False, self.score)
+            if len(self._seen) < self.LOOP_HASHES:
+                self._seen.add(self.hash)
         if (self.looped>self.LOOPED_VALUE):
             self.died = True
             return (SnakeBasic.REWARD_LOOPED, False, self.score)
@@ -116,22 +397,24 @@ class SnakeBasic:
         return (SnakeBasic.REWARD_LIVED, False, self.score)
 
     def is_collision(self, point: Point):
+        return self._is_collision_xy(point.x, point.y)
+    
+    def _is_collision_xy(self, x: int, y: int):
         # check if out of map
-        if (point.x >= self.arena_dimensions[0] or point.x < 0 or\
-            point.y >= self.arena_dimensions[1] or point.y < 0):
+        if (x >= self.arena_dimensions[0] or x < 0 or\
+            y >= self.arena_dimensions[1] or y < 0):
             return True
 
         # check for collision with snake
-        if(point in self.snake_body_pos[:-1] or\
-            point == self.snake_head_pos):
-            return True
+        cell = y * self.arena_dimensions[0] + x
+        if not self.grid[cell]:
+            return False
         
-        # 
-        if len(self.snake_body_pos) == 2 and\
-            point == self.snake_body_pos[-1]:
-            return True
+        # the tail moves away, unless the snake is only two blocks long
+        if cell == self.snake_body[-1] and len(self.snake_body) > 2:
+            return False
         
-        return False  
+        return True  
     
     def _get_input_1(self):
         matrix = [[ObjectsCodes.VOID for y in range(0, self.arena_dimensions[1])] for x in range(0, self.arena_dimensions[0])]
@@ -168,6 +451,60 @@ class SnakeBasic:
         
         return matrix
 
+    def get_grid_observation(self, out = None, layout: str = 'planes'):
+        '''
+        Board as a uint8 numpy array indexed [channel, y, x], kept up to date incrementally by tick.
+        
+        layout 'planes': (3, H, W) snake body (head included), head, apple
+        layout 'codes': (1, H, W) ObjectsCodes values
+        
+        Without out the cached planes are returned for 'planes' - copy them if you keep them.
+        '''
+        if self._planes is None:
+            self._build_planes()
+        
+        if layout == 'planes':
+            if out is None:
+                return self._planes
+            np.copyto(out, self._planes)
+            return out
+        
+        if layout == 'codes':
+            if out is None:
+                if self._codes is None:
+                    self._codes = np.zeros((1, self.arena_dimensions[1], self.arena_dimensions[0]), dtype = np.uint8)
+                out = self._codes
+            np.multiply(self._planes[0], ObjectsCodes.SNAKE, out = out[0])
+            out[0, self._head_y, self._head_x] = ObjectsCodes.SNAKE_HEAD
+            out[0, self.apple_pos.y, self.apple_pos.x] = ObjectsCodes.APPLE
+            return out
+        
+        raise ValueError(f'Unknown layout {layout}')
+    
+    def _build_planes(self):
+        width, height = self.arena_dimensions
+        self._planes = np.zeros((3, height, width), dtype = np.uint8)
+        self._codes = None
+        
+        self._planes[0] = np.frombuffer(self.grid, dtype = np.uint8).reshape(height, width)
+        self._planes[1, self._head_y, self._head_x] = 1
+        self._planes[2, self.apple_pos.y, self.apple_pos.x] = 1
+    
+    @staticmethod
+    def get_grid_observations(games, out = None, layout: str = 'planes'):
+        '''
+        Batched get_grid_observation
+
+        returns: (N, C, H, W) uint8 array, out if given
+        '''
+        if out is None:
+            width, height = games[0].arena_dimensions
+            out = np.zeros((len(games), 3 if layout == 'planes' else 1, height, width), dtype = np.uint8)
+        
+        for index, game in enumerate(games):
+            game.get_grid_observation(out[index], layout)
+        return out
+    
     def _get_nice_moves(self):
         # nice moves list        
         moves = []
@@ -201,6 +538,44 @@ class SnakeBasic:
         return moves
    
     def _get_basic_input_bin(self):
+        '''
+        24 binary features of the current state, computed once per tick
+        (the post-move state is reused as the next pre-move one), don't modify the returned list
+        '''
+        if self._features is None:
+            self._features = self._compute_basic_input_bin()
+        return self._features
+    
+    def _get_basic_input_key(self):
+        '''
+        _get_basic_input_bin packed into one int, bit i is feature i
+        '''
+        return SnakeBasic.pack_state(self._get_basic_input_bin())
+    
+    @staticmethod
+    def pack_state(state):
+        '''
+        Binary features -> int key (bit i = feature i), fits uint32 for up to 32 features
+        '''
+        key = 0
+        for index, bit in enumerate(state):
+            if bit:
+                key |= 1 << index
+        return key
+    
+    @staticmethod
+    def unpack_states(keys, size: int = 24):
+        '''
+        int keys (n,) -> float32 features (n, size)
+        '''
+        keys = np.asarray(keys, dtype = np.int64)
+        return ((keys[..., None] >> np.arange(size)) & 1).astype(np.float32)
+    
+    def _compute_basic_input_bin(self):
+        width, height = self.arena_dimensions
+        x, y = self._head_x, self._head_y
+        apple_x, apple_y = self.apple_pos.x, self.apple_pos.y
+        
         out = []
         
         # snake_direction
@@ -208,91 +583,302 @@ class SnakeBasic:
                 
         # where apple
         out += [
-            self.apple_pos.x < self.snake_head_pos.x,
-            self.apple_pos.x > self.snake_head_pos.x,
-            self.apple_pos.y < self.snake_head_pos.y,
-            self.apple_pos.y > self.snake_head_pos.y
+            apple_x < x,
+            apple_x > x,
+            apple_y < y,
+            apple_y > y
         ]
         
         # near collision
         out += [
-            self.is_collision(self.snake_head_pos + Direction.UP),
-            self.is_collision(self.snake_head_pos + Direction.DOWN),
-            self.is_collision(self.snake_head_pos + Direction.LEFT),
-            self.is_collision(self.snake_head_pos + Direction.RIGHT)
+            self._is_collision_xy(x, y - 1),
+            self._is_collision_xy(x, y + 1),
+            self._is_collision_xy(x - 1, y),
+            self._is_collision_xy(x + 1, y)
         ]
         
         # near apple
         out += [
-            self.apple_pos == self.snake_head_pos + Direction.UP,
-            self.apple_pos == self.snake_head_pos + Direction.DOWN,
-            self.apple_pos == self.snake_head_pos + Direction.LEFT,
-            self.apple_pos == self.snake_head_pos + Direction.RIGHT
+            apple_x == x and apple_y == y - 1,
+            apple_x == x and apple_y == y + 1,
+            apple_x == x - 1 and apple_y == y,
+            apple_x == x + 1 and apple_y == y
         ]
         
         #### snake body ####
-        # line down
-        for point in self.snake_body_pos[1:]:
-            if(point.x == self.snake_head_pos.x and point.y > self.snake_head_pos.y):
-                out += [True]
-                break
+        # the head is the only block in its column/row most of the time,
+        # otherwise search the grid on each side of it
+        if self.column_counts[x] > 1:
+            column = x * height
+            out += [
+                # line down
+                self.grid_columns.find(1, column + y + 1, column + height) != -1,
+                # line up
+                self.grid_columns.find(1, column, column + y) != -1
+            ]
         else:
-            out += [False]
+            out += [False, False]
         
-        # line up
-        for point in self.snake_body_pos[1:]:
-            if(point.x == self.snake_head_pos.x and point.y < self.snake_head_pos.y):
-                out += [True]
-                break
-        else:
-            out += [False]
-        
-        # line right
-        for point in self.snake_body_pos[1:]:
-            if(point.y == self.snake_head_pos.y and point.x > self.snake_head_pos.x):
-                out += [True]
-                break
+        if self.row_counts[y] > 1:
+            row = y * width
+            out += [
+                # line right
+                self.grid.find(1, row + x + 1, row + width) != -1,
+                # line left
+                self.grid.find(1, row, row + x) != -1
+            ]
         else:
-            out += [False]
-        
-        # line left
-        for point in self.snake_body_pos[1:]:
-            if(point.y == self.snake_head_pos.y and point.x < self.snake_head_pos.x):
-                out += [True]
-                break
-        else:
-            out += [False]
+            out += [False, False]
         
         #### apple ####
-        # line down
-        out += [self.apple_pos.x == self.snake_head_pos.x and
-                self.apple_pos.y > self.snake_head_pos.y]
-
-        
-        # line up
-        out += [self.apple_pos.x == self.snake_head_pos.x and
-            self.apple_pos.y < self.snake_head_pos.y]
-        
-        # line right
-        out += [self.apple_pos.y == self.snake_head_pos.y and
-            self.apple_pos.x > self.snake_head_pos.x]
-        
-        # line left
-        out += [self.apple_pos.y == self.snake_head_pos.y and
-            self.apple_pos.x < self.snake_head_pos.x]
+        out += [
+            # line down
+            apple_x == x and apple_y > y,
+            # line up
+            apple_x == x and apple_y < y,
+            # line right
+            apple_y == y and apple_x > x,
+            # line left
+            apple_y == y and apple_x < x
+        ]
                 
         return out
 
+class SnakeVecEnv:
+    '''
+    Steps N snake games in lockstep, the whole batch at once with numpy.
+    Rewards are the same as SnakeBasic.tick with DETECT_LOOPS off: only the LOOPED_VALUE counter ends loops here,
+    moves come in batches with no policy versions to tell a closed loop from a repeat.
+    Finished games are reset automatically.
+    '''
+    def __init__(self, num_envs: int, arena_size: tuple[int, int] = (15, 15), seed = None):
+        self.num_envs = num_envs
+        self.arena_dimensions = arena_size
+        self.rng = np.random.default_rng(seed)
+
+        width, height = arena_size
+        self.cells_count = width * height
+
+        # per-direction deltas in Direction.directions order
+        self._dx = np.array([d.x for d in Direction.directions], dtype = np.int64)
+        self._dy = np.array([d.y for d in Direction.directions], dtype = np.int64)
+
+        # occupancy grid, cell index = y * width + x
+        self.grid = np.zeros((num_envs, self.cells_count), dtype = np.uint8)
+        # snake body as a ring buffer of cell indices
+        self.body = np.zeros((num_envs, self.cells_count), dtype = np.int64)
+        self.head_idx = np.zeros(num_envs, dtype = np.int64)
+        self.tail_idx = np.zeros(num_envs, dtype = np.int64)
+        self.length = np.zeros(num_envs, dtype = np.int64)
+
+        self.apple_pos = np.zeros(num_envs, dtype = np.int64)
+        self.snake_direction = np.zeros(num_envs, dtype = np.int64)
+        self.score = np.zeros(num_envs, dtype = np.int64)
+        self.looped = np.zeros(num_envs, dtype = np.int64)
+        self.died = np.zeros(num_envs, dtype = bool)
+
+        # anti looping
+        self.LOOPED_VALUE = 1.5 * width * height
+
+        self.reset()
+
+    def reset(self):
+        '''
+        Resets every game
+
+        returns: observations (N, 24)
+        '''
+        self._reset_envs(np.arange(self.num_envs))
+        return self.get_observations()
+
+    def _reset_envs(self, envs):
+        if len(envs) == 0:
+            return
+        width, height = self.arena_dimensions
+        center = (height // 2) * width + width // 2
+
+        self.grid[envs] = 0
+        self.grid[envs, center] = 1
+        self.body[envs, 0] = center
+        self.head_idx[envs] = 0
+        self.tail_idx[envs] = 0
+        self.length[envs] = 1
+
+        self.snake_direction[envs] = Direction.directions.index(Direction.UP)
+        self.score[envs] = 0
+        self.looped[envs] = 0
+        self.died[envs] = False
+
+        self._place_apples(envs)
+
+    def _place_apples(self, envs):
+        # uniform pick among free cells: random keys, occupied cells masked out
+        keys = self.rng.random((len(envs), self.cells_count))
+        keys[self.grid[envs] != 0] = -1.
+        self.apple_pos[envs] = np.argmax(keys, axis = 1)
+
+    def _head_cells(self):
+        return self.body[np.arange(self.num_envs), self.head_idx]
+
+    def _tail_cells(self):
+        return self.body[np.arange(self.num_envs), self.tail_idx]
+
+    def _is_collision(self, x, y):
+        '''
+        Batched SnakeBasic.is_collision for one cell per game
+        '''
+        width, height = self.arena_dimensions
+        out = (x < 0) | (x >= width) | (y < 0) | (y >= height)
+        cells = np.where(out, 0, y * width + x)
+
+        # tail is only in the way for the two block snake
+        occupied = self.grid[np.arange(self.num_envs), cells] != 0
+        free_tail = (cells == self._tail_cells()) & (self.length > 2)
+
+        return out | (occupied & ~free_tail)
+
+    def step(self, actions):
+        '''
+        Updates every game with actions: ndarray[N] of Direction.directions indices
+
+        returns: (rewards: ndarray[N], dones: ndarray[N], scores: ndarray[N], observations: ndarray[N, 24])
+        scores are taken before finished games get reset
+        '''
+        actions = np.asarray(actions, dtype = np.int64)
+        width = self.arena_dimensions[0]
+        envs = np.arange(self.num_envs)
+
+        rewards = np.full(self.num_envs, SnakeBasic.REWARD_LIVED, dtype = np.float32)
+        dones = np.zeros(self.num_envs, dtype = bool)
+
+        # games which died from looping the tick before, same as SnakeBasic.tick on a dead game
+        stale = self.died.copy()
+        rewards[stale] = 0
+        dones[stale] = True
+        alive = ~stale
+
+        self.snake_direction[alive] = actions[alive]
+
+        head = self._head_cells()
+        x = head % width + self._dx[self.snake_direction]
+        y = head // width + self._dy[self.snake_direction]
+
+        # ran into the wall or itself
+        crashed = alive & self._is_collision(x, y)
+        rewards[crashed] = SnakeBasic.REWARD_GAME_OVER
+        dones[crashed] = True
+
+        moving = alive & ~crashed
+        new_head = y * width + x
+        ate = moving & (new_head == self.apple_pos)
+
+        # free the tail of the snakes which did not eat
+        moved = np.flatnonzero(moving & ~ate)
+        self.grid[moved, self.body[moved, self.tail_idx[moved]]] = 0
+        self.tail_idx[moved] = (self.tail_idx[moved] + 1) % self.cells_count
+
+        # push new heads
+        moving = np.flatnonzero(moving)
+        self.head_idx[moving] = (self.head_idx[moving] + 1) % self.cells_count
+        self.body[moving, self.head_idx[moving]] = new_head[moving]
+        self.grid[moving, new_head[moving]] = 1
+
+        # apples
+        eaten = np.flatnonzero(ate)
+        self.length[eaten] += 1
+        self.score[eaten] += 1
+        self.looped[eaten] = 0
+        rewards[eaten] = SnakeBasic.REWARD_FOOD_EATEN
+        self._place_apples(eaten)
+
+        # anti looping system, the game ends on the next step
+        self.looped[moved] += 1
+        looped = np.zeros(self.num_envs, dtype = bool)
+        looped[moved] = self.looped[moved] > self.LOOPED_VALUE
+        self.died[looped] = True
+        rewards[looped] = SnakeBasic.REWARD_LOOPED
+
+        scores = self.score.copy()
+        self._reset_envs(envs[dones])
+
+        return (rewards, dones, scores, self.get_observations())
+
+    def get_grid_observations(self, out = None):
+        '''
+        Batched SnakeBasic.get_grid_observation with the 'planes' layout
+
+        returns: (N, 3, H, W) uint8 array, out if given
+        '''
+        width, height = self.arena_dimensions
+        envs = np.arange(self.num_envs)
+        if out is None:
+            out = np.zeros((self.num_envs, 3, height, width), dtype = np.uint8)
+
+        out[:, 0] = self.grid.reshape(self.num_envs, height, width)
+        out[:, 1:].fill(0)
+        head = self._head_cells()
+        out[envs, 1, head // width, head % width] = 1
+        out[envs, 2, self.apple_pos // width, self.apple_pos % width] = 1
+        return out
+
+    def get_observations(self):
+        '''
+        Batched SnakeBasic._get_basic_input_bin
+
+        returns: ndarray[N, 24] of uint8
+        '''
+        width, height = self.arena_dimensions
+        envs = np.arange(self.num_envs)
+        out = np.zeros((self.num_envs, 24), dtype = np.uint8)
+
+        head = self._head_cells()
+        hx, hy = head % width, head // width
+        ax, ay = self.apple_pos % width, self.apple_pos // width
+
+        # snake_direction
+        out[envs, self.snake_direction] = 1
+
+        # where apple
+        out[:, 4] = ax < hx
+        out[:, 5] = ax > hx
+        out[:, 6] = ay < hy
+        out[:, 7] = ay > hy
+
+        # near collision and near apple: UP, DOWN, LEFT, RIGHT
+        for i, direction in enumerate((Direction.UP, Direction.DOWN, Direction.LEFT, Direction.RIGHT)):
+            x, y = hx + direction.x, hy + direction.y
+            out[:, 8 + i] = self._is_collision(x, y)
+            out[:, 12 + i] = (ax == x) & (ay == y)
+
+        # snake body in line with the head, the head itself is excluded by the strict comparison
+        grid = self.grid.reshape(self.num_envs, height, width)
+        column = grid[envs, :, hx]
+        row = grid[envs, hy, :]
+        ys = np.arange(height)
+        xs = np.arange(width)
+        out[:, 16] = (column & (ys > hy[:, None])).any(axis = 1)
+        out[:, 17] = (column & (ys < hy[:, None])).any(axis = 1)
+        out[:, 18] = (row & (xs > hx[:, None])).any(axis = 1)
+        out[:, 19] = (row & (xs < hx[:, None])).any(axis = 1)
+
+        # apple in line with the head
+        out[:, 20] = (ax == hx) & (ay > hy)
+        out[:, 21] = (ax == hx) & (ay < hy)
+        out[:, 22] = (ay == hy) & (ax > hx)
+        out[:, 23] = (ay == hy) & (ax < hx)
+
+        return out
+
 class SnakeExtendedBasic(SnakeBasic):
     '''
     Snake Basic but with an ability to display game in subconsole.
     '''
-    def __init__(self, arena_size: tuple = (15, 15), color: str = "0a", name: str = "Snake Game"):
+    def __init__(self, arena_size: tuple = (15, 15), color: str = "0a", name: str = "Snake Game", seed = None):
         import console
         self.console_module = console
 
         # call parent constructor
-        super().__init__(arena_size)
+        super().__init__(arena_size, seed)
 
         # create console
         self.console = console.console(color, name)
@@ -327,8 +913,14 @@ class SnakeWindowed(SnakeBasic):
     def reset(self):
         super().reset()
         self.died_frame = False
+        self._last_frame = None
+    
+    def restore(self, snapshot):
+        super().restore(snapshot)
+        self.died_frame = False
+        self._last_frame = None
     
-    def __init__(self, arena_size: tuple = (15, 15), cell_size: int = 30):
+    def __init__(self, arena_size: tuple = (15, 15), cell_size: int = 30, seed = None):
         # add modules per class only
         global pygame, color_settings
         import color_settings, pygame, pygame.freetype
@@ -338,7 +930,7 @@ class SnakeWindowed(SnakeBasic):
         pygame.freetype.init()
 
         # init patrent constructor
-        super().__init__(arena_size)
+        super().__init__(arena_size, seed)
         self.cell_size = cell_size
 
         # handle death
@@ -389,88 +981,136 @@ class SnakeWindowed(SnakeBasic):
         
         #endregion
     
+    def _segment_rect(self, cell: int, toward: int = None):
+        '''
+        Rect of a snake block, stretched over the grid line towards the next block (closer to the head)
+        '''
+        x, y = cell % self.arena_dimensions[0], cell // self.arena_dimensions[0]
+        left, top = x * self.cell_size + x + 1, y * self.cell_size + y + 1
+        if toward is None:
+            return pygame.Rect(left, top, self.cell_size, self.cell_size)
+        
+        deltapos = toward - cell
+        if deltapos == -1:
+            return pygame.Rect(left - 1, top, self.cell_size + 1, self.cell_size)
+        elif deltapos == 1:
+            return pygame.Rect(left, top, self.cell_size + 1, self.cell_size)
+        elif deltapos < 0:
+            return pygame.Rect(left, top - 1, self.cell_size, self.cell_size + 1)
+        else:
+            return pygame.Rect(left, top, self.cell_size, self.cell_size + 1)
+    
+    def _draw_apple(self):
+        rect = self._segment_rect(self._apple_cell)
+        self.surface.blit(SnakeWindowed.apple_sprite, rect)
+        return rect
+    
+    def _restore(self, rect):
+        self.surface.blit(self._grid, rect, rect)
+        return rect
+    
+    def redraw(self):
+        '''
+        Makes the next draw repaint the whole game, e.g. after the target surface was cleared
+        '''
+        self._last_frame = None
+    
+    def _draw_full(self):
+        # draw grid on surface
+        self.surface.blit(self._grid,(0, 0))
+        
+        body = self.snake_body
+        
+        # draw head
+        pygame.draw.rect(self.surface, color_settings.SNAKE_COLOR, self._segment_rect(body[0]))
+        
+        # draw rest of body
+        for index in range(len(body) - 1, 0, -1):
+            pygame.draw.rect(self.surface, color_settings.SNAKE_COLOR, self._segment_rect(body[index], body[index - 1]))
+            
+        # draw an apple
+        self._draw_apple()
+        
+        return [self.surface.get_rect()]
+    
+    def _draw_step(self):
+        '''
+        Repaints what one tick changed since the last frame
+        
+        returns: dirty rects, None if the game moved on by more than one tick
+        '''
+        last_head, last_tail, last_length, last_apple = self._last_frame
+        body = self.snake_body
+        length = len(body)
+        
+        ate = length == last_length + 1
+        moved = length == last_length
+        if not (ate or moved) or body[0] == last_head:
+            return None
+        if length > 1 and body[1] != last_head:
+            return None
+        if moved and length > 1 and body[-1] == last_tail:
+            return None
+        
+        dirty = []
+        
+        # vacated tail, with the grid line to the block that followed it
+        if moved:
+            dirty.append(self._restore(self._segment_rect(last_tail, body[-1] if length > 1 else None)))
+        
+        # new head and the old head stretched towards it
+        dirty.append(self._segment_rect(body[0]))
+        pygame.draw.rect(self.surface, color_settings.SNAKE_COLOR, dirty[-1])
+        if length > 1:
+            dirty.append(self._segment_rect(body[1], body[0]))
+            pygame.draw.rect(self.surface, color_settings.SNAKE_COLOR, dirty[-1])
+        
+        # moved apple
+        if self._apple_cell != last_apple:
+            if last_apple != body[0]:
+                dirty.append(self._restore(self._segment_rect(last_apple)))
+            dirty.append(self._draw_apple())
+        
+        return dirty
+    
     # draw game onto screen
     def draw(self, surface, offset = (0,0)):
         '''
-        Draws element onto a surface(pygame)
+        Draws element onto a surface(pygame).
+        Keeps the last frame and repaints only the cells that changed since (new head, vacated tail, apples),
+        only those areas are blitted onto surface.
+        
+        returns: dirty rects in surface coordinates, for pygame.display.update(rects)
         '''
-        if self.died_frame == False:
-            # draw grid on surface
-            self.surface.blit(self._grid,(0, 0))
+        if self.died_frame:
+            return []
+        
+        dirty = None
+        if self._last_frame is not None and not self.died:
+            dirty = self._draw_step()
+        if dirty is None:
+            dirty = self._draw_full()
             
-            # draw head
-            pygame.draw.rect(
-                    self.surface,
-                    color_settings.SNAKE_COLOR,
-                    (self.snake_body_pos[0].x * self.cell_size + self.snake_body_pos[0].x + 1,
-                    self.snake_body_pos[0].y * self.cell_size + self.snake_body_pos[0].y + 1,
-                    self.cell_size,
-                    self.cell_size))
+        # draw cross if died
+        if self.died:              
+            pygame.draw.line(self.surface, color_settings.CROSS_COLOR, (0, 0), (self._grid.get_width(), self._grid.get_height()), width = 1)
+            pygame.draw.line(self.surface, color_settings.CROSS_COLOR, (0, self._grid.get_height()), (self._grid.get_width(), 0), width = 1)
             
-            # draw rest of body
-            for index in range(len(self.snake_body_pos) - 1, 0, -1):
-                deltapos = self.snake_body_pos[index - 1] - self.snake_body_pos[index]
-                
-                if deltapos.x == -1 and deltapos.y == 0:   
-                    pygame.draw.rect(
-                        self.surface,
-                        color_settings.SNAKE_COLOR,
-                        (self.snake_body_pos[index].x * self.cell_size + self.snake_body_pos[index].x,
-                        self.snake_body_pos[index].y * self.cell_size + self.snake_body_pos[index].y + 1,
-                        self.cell_size+1,
-                        self.cell_size))
-                elif deltapos.x == 1 and deltapos.y == 0:
-                    pygame.draw.rect(
-                        self.surface,
-                        color_settings.SNAKE_COLOR,
-                        (self.snake_body_pos[index].x * self.cell_size + self.snake_body_pos[index].x + 1,
-                        self.snake_body_pos[index].y * self.cell_size + self.snake_body_pos[index].y + 1,
-                        self.cell_size + 1,
-                        self.cell_size))
-                elif deltapos.x == 0 and deltapos.y == -1:
-                    pygame.draw.rect(
-                        self.surface,
-                        color_settings.SNAKE_COLOR,
-                        (self.snake_body_pos[index].x * self.cell_size + self.snake_body_pos[index].x + 1,
-                        self.snake_body_pos[index].y * self.cell_size + self.snake_body_pos[index].y,
-                        self.cell_size,
-                        self.cell_size + 1))
-                elif deltapos.x == 0 and deltapos.y == 1:
-                    pygame.draw.rect(
-                        self.surface,
-                        color_settings.SNAKE_COLOR,
-                        (self.snake_body_pos[index].x * self.cell_size + self.snake_body_pos[index].x + 1,
-                        self.snake_body_pos[index].y * self.cell_size + self.snake_body_pos[index].y + 1,
-                        self.cell_size,
-                        self.cell_size + 1))
-                    
-                self.surface.blit(SnakeWindowed.apple_sprite, (
-                    self.apple_pos.x * self.cell_size + self.apple_pos.x+ 1,
-                    self.apple_pos.y * self.cell_size + self.apple_pos.y+ 1,
-                    self.cell_size,
-                    self.cell_size))
-                
-            # draw an apple
-            self.surface.blit(SnakeWindowed.apple_sprite, 
-                (self.apple_pos.x * self.cell_size + self.apple_pos.x + 1,
-                self.apple_pos.y * self.cell_size + self.apple_pos.y + 1,
-                self.cell_size,
-                self.cell_size))
             
-            # draw cross if died
-            if self.died:              
-                pygame.draw.line(self.surface, color_settings.CROSS_COLOR, (0, 0), (self._grid.get_width(), self._grid.get_height()), width = 1)
-                pygame.draw.line(self.surface, color_settings.CROSS_COLOR, (0, self._grid.get_height()), (self._grid.get_width(), 0), width = 1)
-                
-                
-                text_rect = SnakeWindowed.pixelfont.get_rect('died', size = 20)
-                text_rect.center = self.surface.get_rect().center 
+            text_rect = SnakeWindowed.pixelfont.get_rect('died', size = 20)
+            text_rect.center = self.surface.get_rect().center 
 
-                SnakeWindowed.pixelfont.render_to(self.surface, text_rect, 'died', color_settings.TEXT_COLOR, size = 20)
-                
-                self.died_frame = True
-                
-        surface.blit(self.surface, offset)
+            SnakeWindowed.pixelfont.render_to(self.surface, text_rect, 'died', color_settings.TEXT_COLOR, size = 20)
+            
+            self.died_frame = True
+            dirty = [self.surface.get_rect()]
+        
+        self._last_frame = (self.snake_body[0], self.snake_body[-1], len(self.snake_body), self._apple_cell)
+        
+        rects = []
+        for rect in dirty:
+            rects.append(surface.blit(self.surface, (rect.x + offset[0], rect.y + offset[1]), rect))
+        return rects
 
 # enum direction
 class Direction:
@@ -480,6 +1120,13 @@ class Direction:
     RIGHT = Point(1, 0)
     
     directions = [UP, RIGHT, DOWN, LEFT]
+    
+    @staticmethod
+    def deltas(width: int):
+        '''
+        directions as deltas of a y * width + x cell index
+        '''
+        return [direction.y * width + direction.x for direction in Direction.directions]
         
 # enum objects codes
 class ObjectsCodes:
@@ -496,6 +1143,8 @@ def main():
     
     display = pygame.display.set_mode((1280, 720))
     pygame.display.set_caption('Snake')
+    display.fill((10,10, 10))
+    pygame.display.update()
     clock = pygame.time.Clock()
     
     TICK_INTERVAL = 300
@@ -505,6 +1154,7 @@ def main():
     game = SnakeWindowed((10, 10), 30)
     
     while 1:
+        dirty = []
         # handling events
         for event in pygame.event.get():
             # quiting from an app
@@ -529,15 +1179,13 @@ def main():
             # game update game
             game.tick(direction)
 
-            # clearing out the window
-            display.fill((10,10, 10))
             #print('\n'.join(map(str, game._get_matrix())))
-            # draw game
-            game.draw(display, (0, 0))
+            # draw game, only the changed cells
+            dirty = game.draw(display, (0, 0))
         
              
         # update the screen
-        pygame.display.update()
+        pygame.display.update(dirty)
         
         
         # control fps and get the interval
@@ -20,4 +20,41 @@ def plot(scores, mean_scores):
     plt.text(len(mean_scores)-1, mean_scores[-1], str(mean_scores[-1]))
     plt.show(block=False)
     plt.pause(.1)
-    
\ No newline at end of file
+    
+def watch(path = './metrics/metrics.jsonl', refresh: float = 2.):
+    '''
+    Plots a metrics file written by metrics.MetricsSink while training appends to it.
+    Runs in its own process, at its own refresh rate.
+    '''
+    from metrics import read_records
+
+    scores = []
+    mean_scores = []
+    fieldnames = None
+    
+    while not os.path.exists(path):
+        plt.pause(refresh)
+    
+    with open(path, newline = '') as file:
+        while 1:
+            records, fieldnames = read_records(file, path.endswith('.csv'), fieldnames)
+            
+            if records:
+                scores += [record['score'] for record in records]
+                mean_scores += [record['mean_score'] for record in records]
+                
+                plt.clf()
+                plt.title('Training...')
+                plt.xlabel('Number of Games')
+                plt.ylabel('Score')
+                plt.plot(scores)
+                plt.plot(mean_scores)
+                plt.ylim(ymin=0)
+                plt.text(len(scores)-1, scores[-1], str(scores[-1]))
+                plt.text(len(mean_scores)-1, mean_scores[-1], f'{mean_scores[-1]:.2f}')
+            
+            plt.pause(refresh)
+
+if __name__ == '__main__':
+    import sys
+    watch(*sys.argv[1:2])
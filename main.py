@@ -1,146 +1,378 @@
 from game import SnakeBasic, SnakeWindowed, Direction
 
 import numpy as np
-from collections import deque
 from console_colors import colors
 
-from model import Linear_QNet, QTrainer
-from helper import plot
+from model import Linear_QNet, QTrainer, QInference, QCache
+from replay_buffer import ReplayBuffer, PrioritizedReplayBuffer
+from profiler import PhaseTimer, ProfileWindow, DISABLED
+from scheduler import TrainScheduler
 
+import time
 import random
-import torch
-import pygame
 
 MAX_MEMORY = 100_000
 BATCH_SIZE = 1000
 LR = 0.001
+PRIORITIZED_REPLAY = False
+Q_CACHE_SIZE = 4096 # packed states
+
+# update cadence, see TrainScheduler
+TRAIN_EVERY = 4 # env steps between replay updates
+GRADIENT_STEPS = 1 # replay batches per update
+TRAIN_BATCH_SIZE = 64
+REPLAY_RATIO = None # replayed transitions per env step, overrides GRADIENT_STEPS
+SHORT_MEMORY = False # batch-of-1 update on every tick as well
 
 SNAKE_DIMENSIONS = (23, 23)
+PRINT_EVERY = 10 # games
+CHECKPOINT_EVERY = 100 # games
+CHECKPOINT_MEMORY = False # save replay memory with the checkpoints
 
 class Agent:
-    def __init__(self):
+    def __init__(self, prioritized: bool = PRIORITIZED_REPLAY, architecture: tuple = (24, 256, 128, 4), lr: float = LR,
+                 gamma: float = .9, batch_size: int = BATCH_SIZE, memory_size: int = MAX_MEMORY, epsilon_games: int = 80,
+                 schedule: TrainScheduler = None):
         self.n_games = 0
+        self.total_score = 0
         self.epsilon = 0 # randomness
-        self.gamma = .9 # discount rate
-        self.memory = deque(maxlen = MAX_MEMORY) # popleft
+        self.epsilon_games = epsilon_games # games with random moves, fewer and fewer of them
+        self.gamma = gamma # discount rate
+        self.batch_size = batch_size
+        
+        # overwrites oldest, prioritized one samples by TD error
+        self.prioritized = prioritized
+        # states are binary, stored packed into 4 bytes
+        if prioritized:
+            self.memory = PrioritizedReplayBuffer(memory_size, architecture[0], packed = True)
+        else:
+            self.memory = ReplayBuffer(memory_size, architecture[0], packed = True)
+        
+        # load model - self.model = Linear_QNet.load(), resume everything - checkpoint.resume()
+        self.model = Linear_QNet(architecture)
+        self.trainer = QTrainer(self.model, lr = lr, gamma = self.gamma)        
+        self.inference = QInference(self.model, self.trainer)
+        self.q_cache = QCache(self.inference, Q_CACHE_SIZE)
         
-        # load model - self.model = Linear_QNet.load()
-        self.model = Linear_QNet((24, 256, 128, 4))
-        self.trainer = QTrainer(self.model, lr = LR, gamma = self.gamma)        
+        # trajectory_store.TrajectoryWriter keeping every transition on disk, optional
+        self.recorder = None
+        
+        # when to train
+        if schedule is None:
+            schedule = TrainScheduler(TRAIN_EVERY, GRADIENT_STEPS, TRAIN_BATCH_SIZE, REPLAY_RATIO, SHORT_MEMORY)
+        self.schedule = schedule
         
     def get_state(self, game: SnakeBasic):        
-        return np.array(game._get_basic_input_bin(), dtype = np.int)
+        return np.array(game._get_basic_input_bin(), dtype = int)
     
     def remember(self, state, action, reward, next_state, done):
-        self.memory.append((state, action, reward, next_state, done))  # popleft if MAX_MEMORY is reached
+        self.memory.push(state, action, reward, next_state, done)  # overwrites oldest if memory_size is reached
+        if self.recorder is not None:
+            self.recorder.push(state, action, reward, next_state, done)
 
-    def train_long_memory(self):
-        if len(self.memory) > BATCH_SIZE:
-            mini_sample = random.sample(self.memory, BATCH_SIZE) # list of tuples
+    def train_long_memory(self, batch_size: int = None):
+        '''
+        One replay batch, of batch_size or the agent's batch_size
+        
+        returns: mean squared TD error of the replayed batch
+        '''
+        batch_size = batch_size or self.batch_size
+        if self.prioritized:
+            batch, indices, weights = self.memory.sample_weighted(batch_size)
+            td_errors = self.trainer.train_step(*batch, weights = weights)
+            self.memory.update_priorities(indices, td_errors)
         else:
-            mini_sample = self.memory
-            
-        states, actions, rewards, next_states, dones = zip(*mini_sample)
-        self.trainer.train_step(states, actions, rewards, next_states, dones)
+            # whole memory if it's smaller than batch_size
+            states, actions, rewards, next_states, dones = self.memory.sample(batch_size)
+            td_errors = self.trainer.train_step(states, actions, rewards, next_states, dones)
+        
+        return (td_errors ** 2).mean().item()
 
     def train_short_memory(self, state, action, reward, next_state, done):
         self.trainer.train_step(state, action, reward, next_state, done)
     
     def get_action(self, state, game: SnakeBasic):
         # random moves tradeoff exploratation /exploitation
-        self.epsilon = 80 - self.n_games
+        self.epsilon = self.epsilon_games - self.n_games
         move = 0
         
         if random.randint(0, 200) < self.epsilon:
             move = random.randint(0, 3)
+            # the snake can leave a loop it's in now, don't take a repeat for one
+            game.forget_positions()
                      
             # get nice moves from game
             #move = Direction.directions.index(random.choice(game._get_nice_moves()))      
         else:
-            state0 = torch.tensor(state, dtype=torch.float)
-            prediction = self.model(state0)
-            move = torch.argmax(prediction).item()
+            # a loop only closes while the weights stay the same
+            game.follow_policy(self.trainer.steps)
+            move = self.q_cache.act(SnakeBasic.pack_state(state), state)
         
         return move
             
-def train():
+def play_tick(agent: Agent, game: SnakeBasic, phases: PhaseTimer = DISABLED):
+    '''
+    Plays one move, remembers it and trains as agent.schedule says
+    
+    returns: (reward: float, game_over: bool, score: int)
+    '''
+    # get old state
+    with phases.phase('features'):
+        state_old = agent.get_state(game)
+    
+    # get_move
+    with phases.phase('inference'):
+        move = agent.get_action(state_old, game)
+    
+    move_vector = [0, 0, 0, 0]
+    move_vector[move] = 1
+    
+    # perform a move and get new state
+    with phases.phase('env'):
+        reward, done, score = game.tick(move)
+    with phases.phase('features'):
+        state_new = agent.get_state(game)
+    
+    # train short memory
+    with phases.phase('short_memory'):
+        if agent.schedule.short_memory:
+            agent.train_short_memory(state_old, move_vector, reward, state_new, done)
+        agent.remember(state_old, move_vector, reward, state_new, done)
+    
+    # replay updates due
+    with phases.phase('replay'):
+        agent.schedule.step(agent)
+    
+    phases.step()
+    return (reward, done, score)
+
+def finish_game(agent: Agent, game: SnakeBasic, score: int, record: int, steps: int, elapsed: float, metrics = None,
+                phases: PhaseTimer = DISABLED, profile_window: ProfileWindow = None, checkpointer = None):
+    '''
+    Resets the game, trains long memory(replay), saves a new record and logs the game to metrics.
+    With a checkpointer the record model and a full checkpoint every CHECKPOINT_EVERY games are written in the background.
+    
+    returns: record
+    '''
+    # most ticks the looped counter could have run on after the loop was detected
+    loop_detected, loop_ticks_saved_max = game.loop_detected, game.loop_ticks_saved_max
+    game.reset()
+    agent.n_games += 1
+    agent.total_score += score
+    with phases.phase('replay'):
+        loss = agent.schedule.end_game(agent)
+    
+    with phases.phase('checkpoint'):
+        if score > record:
+            record = score
+            if checkpointer is None:
+                agent.model.save()
+            else:
+                checkpointer.save(agent, record, 'model.pth')
+        
+        if checkpointer is not None and agent.n_games % CHECKPOINT_EVERY == 0:
+            checkpointer.save(agent, record, 'checkpoint.pth', CHECKPOINT_MEMORY)
+    
+    with phases.phase('metrics'):
+        mean_score = agent.total_score / agent.n_games
+        # rates over this game
+        schedule = agent.schedule.metrics()
+        if metrics is not None:
+            metrics.log(game = agent.n_games, score = score, mean_score = mean_score, steps = steps,
+                        epsilon = agent.epsilon, loss = loss, steps_per_sec = steps / max(elapsed, 1e-9),
+                        loop_detected = int(loop_detected), loop_ticks_saved_max = loop_ticks_saved_max,
+                        **agent.q_cache.metrics(), **schedule)
+        
+        if agent.n_games % PRINT_EVERY == 0:
+            print(f'{colors.GREEN}»»»»{colors.ENDC}Game no.{agent.n_games}{colors.GREEN}««««{colors.ENDC}')
+            print(f'\t->mean score = {mean_score:.2f}')
+            print(f'\t->record = {record}')
+            print(f'\t->env steps/sec = {schedule["env_steps_per_sec"]:.0f}, gradient steps/sec = {schedule["gradient_steps_per_sec"]:.1f}')
+    
+    phases.end_game(agent.n_games)
+    if profile_window is not None:
+        profile_window.update(agent.n_games)
+    
+    return record
+
+def train(metrics_path: str = './metrics/metrics.jsonl', phases: PhaseTimer = DISABLED, profile_window: ProfileWindow = None,
+          resume_path: str = None, record_path: str = None, schedule: TrainScheduler = None):
+    import pygame
+    from metrics import MetricsSink
+    from checkpoint import Checkpointer, resume
+    
     #
-    plot_scores = []
-    plot_mean_scores = []
-    total_score = 0
+    metrics = MetricsSink(metrics_path)
+    checkpointer = Checkpointer()
     record = 0
+    steps = 0
+    game_start = time.perf_counter()
     
     # setup pygame
     display = pygame.display.set_mode((720, 720))
     pygame.display.set_caption('Snake')
+    display.fill((10, 10, 10))
+    pygame.display.update()
     clock = pygame.time.Clock()
     
     # some weird stuff
-    agent = Agent()
+    if resume_path:
+        agent, record = resume(resume_path)
+    else:
+        agent = Agent()
+    if schedule is not None:
+        agent.schedule = schedule
+    if record_path:
+        from trajectory_store import TrajectoryWriter
+        agent.recorder = TrajectoryWriter(record_path, agent.model.architecture[0])
     game = SnakeWindowed(SNAKE_DIMENSIONS, 30)
     
     TICK_INTERVAL = 0
     timer = 500
     
+    if profile_window is not None:
+        profile_window.update(agent.n_games)
     
     while 1:
         # handling events
         for event in pygame.event.get():
             # quiting from an app
             if event.type == pygame.QUIT:
+                metrics.close()
+                checkpointer.close()
+                if agent.recorder is not None:
+                    agent.recorder.close()
                 exit(0)        
         
         
+        dirty = []
         if timer > TICK_INTERVAL:
             timer -= TICK_INTERVAL
             
-            # get old state
-            state_old = agent.get_state(game)
+            reward, done, score = play_tick(agent, game, phases)
+            steps += 1
             
-            # get_move
-            move = agent.get_action(state_old, game)
-            
-            move_vector = [0, 0, 0, 0]
-            move_vector[move] = 1
-            
-            # perform a move and get new state
-            reward, done, score = game.tick(move)                        
-            # draw game
-            display.fill((10, 10, 10))
-            game.draw(display, (0, 0))
-            
-            state_new = agent.get_state(game)
-            
-            # train short memory
-            agent.train_short_memory(state_old, move_vector, reward, state_new, done)
-            
-            agent.remember(state_old, move_vector, reward, state_new, done)
+            # draw game, only the changed cells
+            with phases.phase('render'):
+                dirty = game.draw(display, (0, 0))
             
             if done:
-                # train long memory(replay), plot result
-                game.reset()
-                agent.n_games += 1
-                agent.train_long_memory()
-                
-                if score > record:
-                    record = score
-                    agent.model.save()
-            
-                print(f'{colors.GREEN}»»»»{colors.ENDC}Game no.{agent.n_games}{colors.GREEN}««««{colors.ENDC}')
-                print(f'\t->score = {score}')
-                print(f'\t->record = {record}')
-                
-                plot_scores.append(score)
-                total_score += score
-                mean_score = total_score / agent.n_games
-                plot_mean_scores.append(mean_score)
-                plot(plot_scores, plot_mean_scores)
+                # train long memory(replay), log result
+                record = finish_game(agent, game, score, record, steps, time.perf_counter() - game_start, metrics,
+                                     phases, profile_window, checkpointer)
+                steps = 0
+                game_start = time.perf_counter()
             
         # update the screen
-        pygame.display.update()
+        pygame.display.update(dirty)
         
         # control fps and get the interval
         timer += clock.tick(120)
+
+def train_headless(render_every: int = 0, max_games: int = None, metrics_path: str = './metrics/metrics.jsonl',
+                   phases: PhaseTimer = DISABLED, profile_window: ProfileWindow = None, resume_path: str = None,
+                   record_path: str = None, schedule: TrainScheduler = None):
+    '''
+    Trains without a window or frame cap, pygame is not imported at all
+    unless render_every is set - then every render_every-th game is drawn at 120 fps.
+    '''
+    from metrics import MetricsSink
+    from checkpoint import Checkpointer, resume
+    
+    metrics = MetricsSink(metrics_path)
+    checkpointer = Checkpointer()
+    record = 0
+    steps = 0
+    game_start = time.perf_counter()
+    if resume_path:
+        agent, record = resume(resume_path)
+    else:
+        agent = Agent()
+    if schedule is not None:
+        agent.schedule = schedule
+    if record_path:
+        from trajectory_store import TrajectoryWriter
+        agent.recorder = TrajectoryWriter(record_path, agent.model.architecture[0])
     
+    if render_every:
+        import pygame
+        display = pygame.display.set_mode((720, 720))
+        pygame.display.set_caption('Snake')
+        display.fill((10, 10, 10))
+        pygame.display.update()
+        clock = pygame.time.Clock()
+        game = SnakeWindowed(SNAKE_DIMENSIONS, 30)
+    else:
+        game = SnakeBasic(SNAKE_DIMENSIONS)
+    
+    if profile_window is not None:
+        profile_window.update(agent.n_games)
+    
+    # buffered transitions, metrics and queued checkpoints are written however training stops
+    try:
+        while max_games is None or agent.n_games < max_games:
+            rendered = render_every and agent.n_games % render_every == 0
+            
+            reward, done, score = play_tick(agent, game, phases)
+            steps += 1
+            
+            if rendered:
+                for event in pygame.event.get():
+                    if event.type == pygame.QUIT:
+                        return agent
+                
+                with phases.phase('render'):
+                    pygame.display.update(game.draw(display, (0, 0)))
+                clock.tick(120)
+            
+            if done:
+                record = finish_game(agent, game, score, record, steps, time.perf_counter() - game_start, metrics,
+                                     phases, profile_window, checkpointer)
+                steps = 0
+                game_start = time.perf_counter()
+                
+                # keep the window responsive between rendered games
+                if render_every:
+                    pygame.event.pump()
+    finally:
+        metrics.close()
+        checkpointer.close()
+        if agent.recorder is not None:
+            agent.recorder.close()
+    return agent
+
 if __name__ == '__main__':
-    train()
\ No newline at end of file
+    import argparse
+    
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--headless', action = 'store_true', help = 'train without a window and frame cap')
+    parser.add_argument('--render-every', type = int, default = 0, help = 'headless: draw every N-th game')
+    parser.add_argument('--games', type = int, default = None, help = 'headless: stop after this many games')
+    parser.add_argument('--actors', type = int, default = 0, help = 'train with this many actor processes (headless)')
+    parser.add_argument('--metrics', default = './metrics/metrics.jsonl', help = 'per-game metrics file, .jsonl or .csv')
+    parser.add_argument('--profile', action = 'store_true', help = 'time training phases (toggle at runtime with SIGUSR1)')
+    parser.add_argument('--profile-every', type = int, default = 100, help = 'print phase timings every N games')
+    parser.add_argument('--capture', type = int, nargs = 2, metavar = ('K', 'M'), help = 'profile games K..K+M')
+    parser.add_argument('--capture-with', choices = ('cprofile', 'torch'), default = 'cprofile')
+    parser.add_argument('--resume', nargs = '?', const = './model/checkpoint.pth', help = 'continue from a checkpoint')
+    parser.add_argument('--record', nargs = '?', const = './trajectories', help = 'append every transition to this folder')
+    parser.add_argument('--train-every', type = int, default = TRAIN_EVERY, help = 'env steps between replay updates, 0 for none')
+    parser.add_argument('--gradient-steps', type = int, default = GRADIENT_STEPS, help = 'replay batches per update')
+    parser.add_argument('--train-batch-size', type = int, default = TRAIN_BATCH_SIZE)
+    parser.add_argument('--replay-ratio', type = float, default = REPLAY_RATIO, help = 'replayed transitions per env step')
+    parser.add_argument('--short-memory', action = 'store_true', default = SHORT_MEMORY, help = 'also train on every tick (batch of 1)')
+    args = parser.parse_args()
+    
+    phases = PhaseTimer(args.profile, summary_every = args.profile_every)
+    phases.toggle_on_signal()
+    profile_window = ProfileWindow(*args.capture, args.capture_with) if args.capture else None
+    schedule = TrainScheduler(args.train_every, args.gradient_steps, args.train_batch_size, args.replay_ratio, args.short_memory)
+    
+    if args.actors:
+        import actor_learner
+        actor_learner.train_parallel(args.actors, args.games,
+                                     replay_ratio = args.replay_ratio if args.replay_ratio is not None else actor_learner.REPLAY_RATIO)
+    elif args.headless:
+        train_headless(args.render_every, args.games, args.metrics, phases, profile_window, args.resume, args.record, schedule)
+    else:
+        train(args.metrics, phases, profile_window, args.resume, args.record, schedule)
@@ -0,0 +1,95 @@
+import os
+import csv
+import json
+import time
+import queue
+import threading
+
+class MetricsSink:
+    '''
+    Appends per-game records to a JSONL or CSV file (by extension) from a background thread,
+    log() never waits on the disk.
+    '''
+    def __init__(self, path: str = './metrics/metrics.jsonl', flush_interval: float = 1.):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.csv = path.endswith('.csv')
+
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+
+        self._queue = queue.SimpleQueue()
+        self._thread = threading.Thread(target = self._run, daemon = True)
+        self._thread.start()
+
+    def log(self, **record):
+        self._queue.put(record)
+
+    def close(self):
+        '''
+        Writes out everything logged so far and stops the thread
+        '''
+        self._queue.put(None)
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _run(self):
+        writer = None
+        with open(self.path, 'a', newline = '', buffering = 1 << 16) as file:
+            header_written = file.tell() > 0
+            last_flush = time.monotonic()
+
+            while True:
+                try:
+                    record = self._queue.get(timeout = self.flush_interval)
+                except queue.Empty:
+                    record = ...
+
+                if record is None:
+                    break
+
+                if record is not ...:
+                    if not self.csv:
+                        file.write(json.dumps(record) + '\n')
+                    else:
+                        if writer is None:
+                            writer = csv.DictWriter(file, fieldnames = list(record), extrasaction = 'ignore')
+                            if not header_written:
+                                writer.writeheader()
+                        writer.writerow(record)
+
+                if time.monotonic() - last_flush >= self.flush_interval:
+                    file.flush()
+                    last_flush = time.monotonic()
+
+def read_records(file, csv_format: bool = False, fieldnames = None):
+    '''
+    Parses complete lines appended to an open metrics file since the last call
+
+    returns: (records, fieldnames)
+    '''
+    records = []
+    while True:
+        position = file.tell()
+        line = file.readline()
+
+        # partial line, the sink hasn't flushed all of it yet
+        if not line.endswith('\n'):
+            file.seek(position)
+            break
+
+        if not csv_format:
+            records.append(json.loads(line))
+        elif fieldnames is None:
+            fieldnames = next(csv.reader([line]))
+        else:
+            values = next(csv.reader([line]))
+            records.append({key: float(value) for key, value in zip(fieldnames, values) if value != ''})
+
+    return (records, fieldnames)
@@ -4,6 +4,8 @@ import torch.optim as optim
 import torch.nn.functional as F
     
 import os
+import numpy as np
+from collections import OrderedDict
 
 class Linear_QNet(nn.Module):
     def __init__(self, architecture):
@@ -23,13 +25,24 @@ class Linear_QNet(nn.Module):
         if not os.path.exists(model_folder_path):
             os.makedirs(model_folder_path)
         
+        # write aside and swap in, a crash never leaves a half written file
         file_name = os.path.join(model_folder_path, file_name)
-        torch.save(self.state_dict(), file_name)
+        torch.save({'architecture': tuple(self.architecture), 'model': self.state_dict()}, file_name + '.tmp')
+        os.replace(file_name + '.tmp', file_name)
     
     @staticmethod
-    def load(architecture, path='./model/model.pth'):
+    def load(architecture=None, path='./model/model.pth'):
+        '''
+        Loads a model saved by save() or checkpoint.Checkpointer,
+        architecture is only needed for files holding a bare state_dict
+        '''
+        saved = torch.load(path)
+        if 'model' in saved:
+            architecture = architecture or saved['architecture']
+            saved = saved['model']
+        
         model = Linear_QNet(architecture)
-        model.load_state_dict(torch.load(path))
+        model.load_state_dict(saved)
         model.eval()
         return model
     
@@ -40,12 +53,22 @@ class QTrainer:
         self.model = model
         self.optimizer = optim.Adam(model.parameters(), lr=self.lr)
         self.criterion = nn.MSELoss()
+        # optimizer steps taken, lets QInference know when its weights are stale
+        self.steps = 0
     
-    def train_step(self, state, action, reward, next_state, done):
-        state = torch.tensor(state, dtype=torch.float)
-        next_state = torch.tensor(next_state, dtype=torch.float)
-        action = torch.tensor(action, dtype=torch.long)
-        reward = torch.tensor(reward, dtype=torch.float)
+    def train_step(self, state, action, reward, next_state, done, weights=None):
+        '''
+        One optimizer step on a single transition or a batch of them.
+        action can be an index or a one-hot vector (as main.py builds it),
+        weights are optional per-sample importance-sampling weights.
+
+        returns: per-sample TD errors (n,)
+        '''
+        state = torch.as_tensor(state, dtype=torch.float)
+        next_state = torch.as_tensor(next_state, dtype=torch.float)
+        action = torch.as_tensor(action, dtype=torch.long)
+        reward = torch.as_tensor(reward, dtype=torch.float)
+        done = torch.as_tensor(done, dtype=torch.bool)
         # (n, x)
 
         if len(state.shape) == 1:
@@ -54,24 +77,122 @@ class QTrainer:
             next_state = torch.unsqueeze(next_state, 0)
             action = torch.unsqueeze(action, 0)
             reward = torch.unsqueeze(reward, 0)
-            done = (done, )
+            done = torch.unsqueeze(done, 0)
+
+        # one-hot actions -> indices
+        if len(action.shape) == 2:
+            action = torch.argmax(action, dim=1)
 
         # 1: predicted Q values with current state
         pred = self.model(state)
 
-        target = pred.clone()
-        for idx in range(len(done)):
-            Q_new = reward[idx]
-            if not done[idx]:
-                Q_new = reward[idx] + self.gamma * torch.max(self.model(next_state[idx]))
-
-            target[idx][torch.argmax(action[idx]).item()] = Q_new
-    
         # 2: Q_new = r + y * max(next_predicted Q value) -> only do this if not done
+        Q_next = torch.max(self.model(next_state), dim=1).values
+        Q_new = torch.where(done, reward, reward + self.gamma * Q_next)
+
         # pred.clone()
         # pred[argmax(action)] = Q_new
+        target = pred.clone()
+        target[torch.arange(len(action)), action] = Q_new
+
         self.optimizer.zero_grad()
-        loss = self.criterion(target, pred)
+        if weights is None:
+            loss = self.criterion(target, pred)
+        else:
+            loss = (torch.as_tensor(weights, dtype=torch.float).unsqueeze(1) * (target - pred) ** 2).mean()
         loss.backward()
 
-        self.optimizer.step()
\ No newline at end of file
+        self.optimizer.step()
+        self.steps += 1
+
+        return (Q_new - pred[torch.arange(len(action)), action]).detach()
+
+class QInference:
+    '''
+    Acting with a Linear_QNet without torch: its weights copied into contiguous float32 numpy arrays,
+    copied again only after the trainer has taken an optimizer step.
+    '''
+    def __init__(self, model, trainer=None):
+        self.model = model
+        self.trainer = trainer
+        self.refresh()
+
+    def refresh(self):
+        '''
+        Copies the current weights, call it after changing the model outside of the trainer
+        '''
+        self.layers = [(np.ascontiguousarray(layer.weight.detach().numpy().T), layer.bias.detach().numpy().copy())
+                       for layer in self.model.layers]
+        self.version = self.trainer.steps if self.trainer is not None else 0
+
+    def q_values(self, states):
+        '''
+        Q values for a state (x,) -> (actions,) or a batch (n, x) -> (n, actions)
+        '''
+        if self.trainer is not None and self.trainer.steps != self.version:
+            self.refresh()
+
+        x = np.asarray(states, dtype=np.float32)
+        for weight, bias in self.layers[:-1]:
+            x = x @ weight
+            x += bias
+            np.maximum(x, 0, out=x)
+
+        weight, bias = self.layers[-1]
+        x = x @ weight
+        x += bias
+        return x
+
+    def act(self, states):
+        '''
+        Greedy action: an int for a single state, an array of them for a batch
+        '''
+        q = self.q_values(states)
+        if q.ndim == 1:
+            return int(q.argmax())
+        return q.argmax(axis=1)
+
+class QCache:
+    '''
+    Bounded LRU cache of Q values keyed by the packed state (SnakeBasic.pack_state).
+    Entries remember the trainer step they were computed at and are stale after any optimizer step.
+    '''
+    def __init__(self, inference, capacity=4096):
+        self.inference = inference
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def q_values(self, key, state):
+        version = self.inference.trainer.steps if self.inference.trainer is not None else 0
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] == version:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+        self.misses += 1
+        q = self.inference.q_values(state)
+        self.entries[key] = (version, q)
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+        return q
+
+    def act(self, key, state):
+        return int(self.q_values(key, state).argmax())
+
+    @property
+    def hit_rate(self):
+        return self.hits / max(self.hits + self.misses, 1)
+
+    def metrics(self):
+        '''
+        returns: {'q_cache_hit_rate', 'q_cache_saved_forwards', 'q_cache_size'}
+        '''
+        return {
+            'q_cache_hit_rate': self.hit_rate,
+            'q_cache_saved_forwards': self.hits,
+            'q_cache_size': len(self.entries),
+        }
@@ -0,0 +1,209 @@
+'''
+Lookahead player: iterative deepening search over SnakeBasic snapshots under a per-move time budget,
+a transposition table keyed by the games' Zobrist hash and Linear_QNet values at the leaves.
+'''
+import time
+
+import numpy as np
+
+from game import SnakeBasic, GameRandom
+
+class _OutOfTime(Exception):
+    pass
+
+class Planner:
+    '''
+    Picks the move with the best discounted return max over move sequences up to max_depth ahead,
+    deepening until budget seconds are up (depth 1 always finishes).
+    Leaves are valued by inference (QInference) as max Q, 0 without one.
+    Apples eaten during the search are replaced from the planner's own rng, it doesn't peek at the game's.
+
+        planner = Planner(QInference(Linear_QNet.load()))
+        move = planner.act(game)
+    '''
+    def __init__(self, inference = None, gamma: float = .9, budget: float = .01, max_depth: int = 8,
+                 table_size: int = 1 << 18, seed = None):
+        self.inference = inference
+        self.gamma = gamma
+        self.budget = budget
+        self.max_depth = max_depth
+        self.table_size = table_size
+        self.rng = GameRandom(seed)
+
+        # hash -> (depth searched, value)
+        self.table = {}
+        self._version = None
+        self._game = None
+
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.nodes = 0
+        self.lookups = 0
+        self.hits = 0
+        self.moves = 0
+        self.depths = 0
+        self.search_time = 0.
+
+    def act(self, game: SnakeBasic):
+        '''
+        returns: move index into Direction.directions
+        '''
+        values = self.search(game)
+        best = np.flatnonzero(values == values.max())
+        # the search depends on its time budget, table and imagined apples, not a fixed policy:
+        # a repeated position isn't a loop, only the LOOPED_VALUE counter ends the planner's games
+        game.forget_positions()
+        return int(best[self.rng.randrange(len(best))])
+
+    def search(self, game: SnakeBasic):
+        '''
+        returns: (4,) values of the moves from game's state, at the deepest depth finished in time
+        '''
+        start = time.perf_counter()
+        self._deadline = start + self.budget
+
+        # stale values once the network has changed
+        version = getattr(self.inference, 'version', None)
+        if version != self._version or len(self.table) > self.table_size:
+            self.table.clear()
+            self._version = version
+
+        if self._game is None or self._game.arena_dimensions != game.arena_dimensions:
+            self._game = SnakeBasic(game.arena_dimensions)
+        self._game.restore(game.snapshot())
+        self._game.LOOPED_VALUE = game.LOOPED_VALUE
+        self._game.rng.state = self.rng.next()
+        root = self._game.snapshot()
+
+        values = self._children(root, 1, False)
+        depth = 1
+        try:
+            for depth in range(2, self.max_depth + 1):
+                values = self._children(root, depth, True)
+        except _OutOfTime:
+            depth -= 1
+
+        self.moves += 1
+        self.depths += depth
+        self.search_time += time.perf_counter() - start
+        return values
+
+    def _children(self, snapshot, depth: int, abortable: bool):
+        '''
+        returns: (4,) values of the moves from snapshot, searching depth moves ahead
+        '''
+        game = self._game
+        values = np.zeros(4)
+        leaves = []
+        leaf_moves = []
+
+        for move in range(4):
+            game.restore(snapshot)
+            reward, done, _ = game.tick(move)
+            self.nodes += 1
+
+            # a looped game is over too, it only says so on the next tick
+            if done or game.died:
+                values[move] = reward
+            elif depth == 1:
+                values[move] = reward
+                leaves.append(game._get_basic_input_bin())
+                leaf_moves.append(move)
+            else:
+                values[move] = reward + self.gamma * self._value(depth - 1, abortable)
+
+        if leaves and self.inference is not None:
+            values[leaf_moves] += self.gamma * self.inference.q_values(np.array(leaves, dtype = np.float32)).max(axis = 1)
+        return values
+
+    def _value(self, depth: int, abortable: bool):
+        '''
+        returns: best value of the current state of the search game, depth moves ahead
+        '''
+        game = self._game
+        key = game.hash
+        self.lookups += 1
+        entry = self.table.get(key)
+        if entry is not None and entry[0] >= depth:
+            self.hits += 1
+            return entry[1]
+
+        if abortable and time.perf_counter() > self._deadline:
+            raise _OutOfTime()
+
+        value = self._children(game.snapshot(), depth, abortable).max()
+        self.table[key] = (depth, value)
+        return value
+
+    @property
+    def hit_rate(self):
+        return self.hits / max(self.lookups, 1)
+
+    def metrics(self):
+        '''
+        returns: {'planner_nodes_per_sec', 'planner_hit_rate', 'planner_mean_depth', 'planner_table_size'}
+        '''
+        return {
+            'planner_nodes_per_sec': self.nodes / max(self.search_time, 1e-9),
+            'planner_hit_rate': self.hit_rate,
+            'planner_mean_depth': self.depths / max(self.moves, 1),
+            'planner_table_size': len(self.table),
+        }
+
+def play(planner: Planner, game: SnakeBasic, recorder = None):
+    '''
+    Plays a game to its end with the planner, the game is reset first.
+    Every transition goes to recorder.push (ReplayBuffer, TrajectoryWriter, ...) as demonstrations.
+
+    returns: score
+    '''
+    game.reset()
+    state = game._get_basic_input_bin()
+    while True:
+        move = planner.act(game)
+        reward, done, score = game.tick(move)
+        next_state = game._get_basic_input_bin()
+        if recorder is not None:
+            recorder.push(state, move, reward, next_state, done)
+        if done:
+            return score
+        state = next_state
+
+def main(argv = None):
+    import argparse
+    parser = argparse.ArgumentParser(description = 'Play games with the lookahead planner')
+    parser.add_argument('--games', type = int, default = 10)
+    parser.add_argument('--arena', type = int, nargs = 2, default = (23, 23), metavar = ('W', 'H'))
+    parser.add_argument('--model', default = None, help = 'saved Linear_QNet for leaf values')
+    parser.add_argument('--budget', type = float, default = .01, help = 'seconds per move')
+    parser.add_argument('--depth', type = int, default = 8, help = 'max search depth')
+    parser.add_argument('--record', default = None, help = 'append the games to this trajectory folder as demonstrations')
+    parser.add_argument('--seed', type = int, default = 0)
+    args = parser.parse_args(argv)
+
+    inference = None
+    if args.model:
+        from model import Linear_QNet, QInference
+        inference = QInference(Linear_QNet.load(path = args.model))
+
+    recorder = None
+    if args.record:
+        from trajectory_store import TrajectoryWriter
+        recorder = TrajectoryWriter(args.record)
+
+    planner = Planner(inference, budget = args.budget, max_depth = args.depth, seed = args.seed)
+    game = SnakeBasic(tuple(args.arena), args.seed)
+    scores = []
+    for n_game in range(args.games):
+        scores.append(play(planner, game, recorder))
+        metrics = planner.metrics()
+        print(f'game {n_game + 1}: score = {scores[-1]}, nodes/sec = {metrics["planner_nodes_per_sec"]:.0f}, '
+              f'hit rate = {metrics["planner_hit_rate"]:.1%}, mean depth = {metrics["planner_mean_depth"]:.1f}')
+    print(f'mean score = {np.mean(scores):.2f}')
+
+    if recorder is not None:
+        recorder.close()
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,6 @@
 class Point:
+    __slots__ = ('x', 'y')
+    
     def __init__(self, x = 0, y = 0):
         self.x = x
         self.y = y
@@ -35,10 +37,13 @@ class Point:
         return Point(self.x, self.y)
         
     def __eq__(self, other):
-        if isinstance(other, Point):
+        try:
             return (other.x == self.x and other.y == self.y)
-        else:
+        except AttributeError:
             return False
     
+    def __hash__(self):
+        return hash((self.x, self.y))
+    
     def __str__(self):
         return "({0},{1})".format(self.x, self.y)        
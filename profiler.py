@@ -0,0 +1,191 @@
+'''
+Training loop instrumentation: per-phase wall time and steps/sec over a rolling window,
+plus an optional cProfile / torch.profiler capture of a range of games.
+'''
+import os
+import time
+import signal
+from collections import deque
+
+import numpy as np
+
+class _Phase:
+    __slots__ = ('timer', 'name', 'start')
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.timer.add(self.name, time.perf_counter() - self.start)
+
+class _NullPhase:
+    __slots__ = ()
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+_NULL_PHASE = _NullPhase()
+
+class PhaseTimer:
+    '''
+    Times the phases of the training loop with the monotonic perf_counter.
+    While disabled phase() hands out a shared no-op context, so the loop pays a call and a with.
+
+        with timer.phase('env'):
+            game.tick(move)
+    '''
+    def __init__(self, enabled: bool = False, window: int = 10_000, summary_every: int = 100):
+        self.enabled = enabled
+        self.window = window
+        self.summary_every = summary_every
+        self.reset()
+
+    def reset(self):
+        # last window durations of every phase, in a ring
+        self._samples = {}
+        self._counts = {}
+        self._totals = {}
+        self._steps = deque(maxlen = self.window)
+
+    def toggle_on_signal(self, signum = getattr(signal, 'SIGUSR1', None)):
+        '''
+        Flip enabled whenever the process gets signum (kill -USR1 <pid>), POSIX only
+        '''
+        if signum is None:
+            return
+        def toggle(*args):
+            self.enabled = not self.enabled
+            print(f'profiling {"on" if self.enabled else "off"}')
+        signal.signal(signum, toggle)
+
+    def phase(self, name: str):
+        if not self.enabled:
+            return _NULL_PHASE
+        return _Phase(self, name)
+
+    def add(self, name: str, seconds: float):
+        samples = self._samples.get(name)
+        if samples is None:
+            samples = self._samples[name] = np.zeros(self.window)
+            self._counts[name] = 0
+            self._totals[name] = 0.
+
+        samples[self._counts[name] % self.window] = seconds
+        self._counts[name] += 1
+        self._totals[name] += seconds
+
+    def step(self, count: int = 1):
+        '''
+        Marks env steps done, for steps/sec
+        '''
+        if self.enabled:
+            self._steps.append((time.perf_counter(), count))
+
+    def steps_per_sec(self):
+        if len(self._steps) < 2:
+            return 0.
+        steps = sum(count for _, count in self._steps) - self._steps[0][1]
+        return steps / max(self._steps[-1][0] - self._steps[0][0], 1e-9)
+
+    def histogram(self, name: str, bins: int = 20):
+        '''
+        Log-spaced histogram of the phase's durations in the window
+
+        returns: (counts, bin edges in seconds)
+        '''
+        samples = self._samples[name][:min(self._counts[name], self.window)]
+        low, high = max(samples.min(), 1e-7), max(samples.max(), 1e-6)
+        return np.histogram(samples, bins = np.geomspace(low, high * 1.0001, bins + 1))
+
+    def summary(self):
+        '''
+        returns: {phase: {count, mean_ms, p50_ms, p90_ms, p99_ms, share}} over the window,
+                 share is the phase's part of all timed time since the last reset
+        '''
+        timed = sum(self._totals.values()) or 1.
+        out = {}
+        for name, samples in self._samples.items():
+            samples = samples[:min(self._counts[name], self.window)] * 1000
+            p50, p90, p99 = np.percentile(samples, (50, 90, 99))
+            out[name] = {
+                'count': self._counts[name],
+                'mean_ms': samples.mean(),
+                'p50_ms': p50,
+                'p90_ms': p90,
+                'p99_ms': p99,
+                'share': self._totals[name] / timed,
+            }
+        return out
+
+    def format_summary(self):
+        lines = [f'{"phase":<14}{"count":>10}{"mean ms":>10}{"p50":>10}{"p90":>10}{"p99":>10}{"share":>8}']
+        for name, stats in sorted(self.summary().items(), key = lambda item: -item[1]['share']):
+            lines.append(f'{name:<14}{stats["count"]:>10}{stats["mean_ms"]:>10.3f}{stats["p50_ms"]:>10.3f}'
+                         f'{stats["p90_ms"]:>10.3f}{stats["p99_ms"]:>10.3f}{stats["share"]:>8.1%}')
+        lines.append(f'steps/sec = {self.steps_per_sec():.0f}')
+        return '\n'.join(lines)
+
+    def end_game(self, n_games: int):
+        '''
+        Prints the summary every summary_every games
+        '''
+        if self.enabled and self.summary_every and n_games % self.summary_every == 0:
+            print(self.format_summary())
+
+# shared disabled timer, default for the training functions
+DISABLED = PhaseTimer(enabled = False)
+
+class ProfileWindow:
+    '''
+    Runs cProfile or torch.profiler from game first_game up to first_game + games,
+    then writes the result into folder (.prof for cProfile, chrome trace json for torch).
+    '''
+    def __init__(self, first_game: int, games: int, kind: str = 'cprofile', folder: str = './profile'):
+        if kind not in ('cprofile', 'torch'):
+            raise ValueError(f'Unknown profiler {kind}')
+        self.first_game = first_game
+        self.last_game = first_game + games
+        self.kind = kind
+        self.folder = folder
+        self._profiler = None
+
+    def update(self, n_games: int):
+        '''
+        Call with the number of finished games whenever a game ends (and once before the first one)
+        '''
+        if n_games == self.first_game and self._profiler is None:
+            self._start()
+        elif n_games >= self.last_game and self._profiler is not None:
+            self._stop()
+
+    def _start(self):
+        if self.kind == 'cprofile':
+            import cProfile
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        else:
+            import torch.profiler
+            self._profiler = torch.profiler.profile(activities = [torch.profiler.ProfilerActivity.CPU])
+            self._profiler.start()
+
+    def _stop(self):
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder)
+        name = os.path.join(self.folder, f'games_{self.first_game}-{self.last_game}')
+
+        if self.kind == 'cprofile':
+            self._profiler.disable()
+            self._profiler.dump_stats(name + '.prof')
+            print(f'cProfile stats saved to {name}.prof')
+        else:
+            self._profiler.stop()
+            self._profiler.export_chrome_trace(name + '.json')
+            print(f'torch trace saved to {name}.json')
+        self._profiler = None
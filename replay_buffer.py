@@ -0,0 +1,210 @@
+import numpy as np
+import torch
+
+from game import SnakeBasic
+
+class ReplayBuffer:
+    '''
+    Replay memory in preallocated numpy arrays, oldest transitions get overwritten once it's full.
+    With packed binary states are kept as uint32 keys (SnakeBasic.pack_state) and unpacked in batch().
+    '''
+    def __init__(self, capacity: int, state_size: int, state_dtype = np.float32, seed = None, packed: bool = False):
+        self.capacity = capacity
+        self.state_size = state_size
+        self.packed = packed
+        self.rng = np.random.default_rng(seed)
+
+        if packed:
+            state_shape, state_dtype = (capacity, ), np.uint32
+        else:
+            state_shape = (capacity, state_size)
+
+        self.states = np.zeros(state_shape, dtype = state_dtype)
+        self.actions = np.zeros(capacity, dtype = np.int64)
+        self.rewards = np.zeros(capacity, dtype = np.float32)
+        self.next_states = np.zeros(state_shape, dtype = state_dtype)
+        self.dones = np.zeros(capacity, dtype = bool)
+
+        # next slot to write and number of stored transitions
+        self.index = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def nbytes(self):
+        '''
+        Memory used by the arrays in bytes
+        '''
+        return (self.states.nbytes + self.actions.nbytes + self.rewards.nbytes +
+                self.next_states.nbytes + self.dones.nbytes)
+
+    def push(self, state, action, reward, next_state, done):
+        '''
+        Stores one transition, action is an index or a one-hot vector
+        '''
+        if not isinstance(action, (int, np.integer)):
+            action = int(np.argmax(action))
+        if self.packed:
+            state, next_state = SnakeBasic.pack_state(state), SnakeBasic.pack_state(next_state)
+
+        self.states[self.index] = state
+        self.actions[self.index] = action
+        self.rewards[self.index] = reward
+        self.next_states[self.index] = next_state
+        self.dones[self.index] = done
+
+        self.index = (self.index + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def push_many(self, states, actions, rewards, next_states, dones):
+        '''
+        Stores a batch of transitions, actions are indices
+
+        returns: slots they were written to
+        '''
+        indices = (self.index + np.arange(len(actions))) % self.capacity
+        if self.packed:
+            powers = 1 << np.arange(self.state_size, dtype = np.int64)
+            states = np.asarray(states, dtype = np.int64) @ powers
+            next_states = np.asarray(next_states, dtype = np.int64) @ powers
+
+        self.states[indices] = states
+        self.actions[indices] = actions
+        self.rewards[indices] = rewards
+        self.next_states[indices] = next_states
+        self.dones[indices] = dones
+
+        self.index = (self.index + len(actions)) % self.capacity
+        self.size = min(self.size + len(actions), self.capacity)
+        return indices
+
+    def sample_indices(self, batch_size: int):
+        '''
+        Uniform sample without replacement, everything if there's not enough transitions
+        '''
+        if self.size > batch_size:
+            return self.rng.choice(self.size, batch_size, replace = False)
+        return np.arange(self.size)
+
+    def batch(self, indices):
+        '''
+        returns: (states, actions, rewards, next_states, dones) as tensors sharing memory with the gathered arrays
+        '''
+        states, next_states = self.states[indices], self.next_states[indices]
+        if self.packed:
+            states = SnakeBasic.unpack_states(states, self.state_size)
+            next_states = SnakeBasic.unpack_states(next_states, self.state_size)
+
+        return (torch.from_numpy(states),
+                torch.from_numpy(self.actions[indices]),
+                torch.from_numpy(self.rewards[indices]),
+                torch.from_numpy(next_states),
+                torch.from_numpy(self.dones[indices]))
+
+    def sample(self, batch_size: int):
+        return self.batch(self.sample_indices(batch_size))
+
+class SumTree:
+    '''
+    Array-backed binary tree where every node holds the sum of its children.
+    Leaves are the priorities, tree[1] is the total.
+    '''
+    def __init__(self, capacity: int):
+        # leaves count rounded up to a power of two, leaf i sits at tree[leaves + i]
+        self.leaves = 1
+        while self.leaves < capacity:
+            self.leaves *= 2
+        self.tree = np.zeros(2 * self.leaves, dtype = np.float64)
+
+    @property
+    def total(self):
+        return self.tree[1]
+
+    def __getitem__(self, indices):
+        return self.tree[self.leaves + np.asarray(indices)]
+
+    def update(self, indices, priorities):
+        '''
+        Sets leaves and fixes their ancestors, O(k log n) for k leaves
+        '''
+        nodes = self.leaves + np.asarray(indices)
+        self.tree[nodes] = priorities
+
+        while nodes[0] > 1:
+            nodes = np.unique(nodes // 2)
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+
+    def find(self, values):
+        '''
+        Leaf index for every prefix sum in values, O(log n) each
+        '''
+        values = np.array(values, dtype = np.float64)
+        nodes = np.ones(len(values), dtype = np.int64)
+
+        while nodes[0] < self.leaves:
+            left = self.tree[2 * nodes]
+            go_right = values >= left
+            values -= left * go_right
+            nodes = 2 * nodes + go_right
+
+        return nodes - self.leaves
+
+class PrioritizedReplayBuffer(ReplayBuffer):
+    '''
+    Replay memory sampled proportionally to TD error, with importance-sampling weights.
+    New transitions get the highest priority seen so far.
+    '''
+    def __init__(self, capacity: int, state_size: int, alpha: float = .6, beta: float = .4,
+                 beta_increment: float = 1e-4, epsilon: float = 1e-3, state_dtype = np.float32, seed = None,
+                 packed: bool = False):
+        super().__init__(capacity, state_size, state_dtype, seed, packed)
+        self.alpha = alpha
+        self.beta = beta
+        self.beta_increment = beta_increment
+        self.epsilon = epsilon
+
+        self.priorities = SumTree(capacity)
+        self.max_priority = 1.
+
+    @property
+    def nbytes(self):
+        return super().nbytes + self.priorities.tree.nbytes
+
+    def push(self, state, action, reward, next_state, done):
+        index = self.index
+        super().push(state, action, reward, next_state, done)
+        self.priorities.update([index], self.max_priority ** self.alpha)
+
+    def push_many(self, states, actions, rewards, next_states, dones):
+        indices = super().push_many(states, actions, rewards, next_states, dones)
+        self.priorities.update(indices, np.full(len(indices), self.max_priority ** self.alpha))
+        return indices
+
+    def sample_weighted(self, batch_size: int):
+        '''
+        Stratified proportional sample
+
+        returns: (batch, indices, weights) - batch as ReplayBuffer.batch, weights normalized to max 1
+        '''
+        batch_size = min(batch_size, self.size)
+
+        # one value from every equal slice of the total priority
+        segment = self.priorities.total / batch_size
+        values = (np.arange(batch_size) + self.rng.random(batch_size)) * segment
+        indices = np.minimum(self.priorities.find(values), self.size - 1)
+
+        probabilities = self.priorities[indices] / self.priorities.total
+        weights = (self.size * probabilities) ** -self.beta
+        weights /= weights.max()
+
+        # anneal towards full correction
+        self.beta = min(1., self.beta + self.beta_increment)
+
+        return (self.batch(indices), indices, torch.from_numpy(weights.astype(np.float32)))
+
+    def update_priorities(self, indices, td_errors):
+        priorities = np.abs(np.asarray(td_errors, dtype = np.float64)) + self.epsilon
+        self.max_priority = max(self.max_priority, float(priorities.max()))
+        self.priorities.update(indices, priorities ** self.alpha)
@@ -0,0 +1,88 @@
+'''
+When the agent trains: replay updates every few env steps, the per-tick single transition update
+(the original cadence) as an option, and separate env steps/sec and gradient steps/sec.
+'''
+import time
+
+class TrainScheduler:
+    '''
+    Every train_every env steps runs gradient_steps replay batches of batch_size,
+    or with replay_ratio (replayed transitions per env step) as many as keep the run at that ratio.
+    short_memory adds the batch-of-1 update on every tick, replay_on_game_end the agent's big batch when a game ends.
+    No replay batch runs before warmup transitions are in memory (batch_size by default).
+    '''
+    def __init__(self, train_every: int = 4, gradient_steps: int = 1, batch_size: int = 64, replay_ratio: float = None,
+                 short_memory: bool = False, replay_on_game_end: bool = True, warmup: int = None):
+        self.train_every = train_every
+        self.gradient_steps_per_update = gradient_steps
+        self.batch_size = batch_size
+        self.replay_ratio = replay_ratio
+        self.short_memory = short_memory
+        self.replay_on_game_end = replay_on_game_end
+        self.warmup = batch_size if warmup is None else warmup
+
+        self.env_steps = 0
+        # optimizer steps of every kind, and the transitions replayed in them
+        self.gradient_steps = 0
+        self.replayed = 0
+        self.last_loss = None
+
+        # window of the rates
+        self._window = (time.perf_counter(), 0, 0)
+
+    def updates_due(self, memory_size: int):
+        '''
+        returns: replay batches to run after the current env step
+        '''
+        if not self.train_every or self.env_steps % self.train_every or memory_size < self.warmup:
+            return 0
+        if self.replay_ratio is None:
+            return self.gradient_steps_per_update
+        return max(0, int(self.replay_ratio * self.env_steps) - self.replayed) // self.batch_size
+
+    def step(self, agent):
+        '''
+        Call after every env step (once the transition is remembered), runs the replay updates due
+
+        returns: loss of the last update, None if there was none
+        '''
+        self.env_steps += 1
+        if self.short_memory:
+            self.gradient_steps += 1
+            self.replayed += 1
+
+        loss = None
+        for _ in range(self.updates_due(len(agent.memory))):
+            loss = self.last_loss = agent.train_long_memory(self.batch_size)
+            self.gradient_steps += 1
+            self.replayed += min(self.batch_size, len(agent.memory))
+        return loss
+
+    def end_game(self, agent):
+        '''
+        Call when a game ends
+
+        returns: loss of the game-end replay, the last loss without one
+        '''
+        if self.replay_on_game_end:
+            self.last_loss = agent.train_long_memory()
+            self.gradient_steps += 1
+            self.replayed += min(agent.batch_size, len(agent.memory))
+        return self.last_loss
+
+    def metrics(self):
+        '''
+        returns: {'env_steps', 'gradient_steps', 'replay_ratio', 'env_steps_per_sec', 'gradient_steps_per_sec'},
+                 the rates since the previous call
+        '''
+        now = time.perf_counter()
+        start, env_steps, gradient_steps = self._window
+        elapsed = max(now - start, 1e-9)
+        self._window = (now, self.env_steps, self.gradient_steps)
+        return {
+            'env_steps': self.env_steps,
+            'gradient_steps': self.gradient_steps,
+            'replay_ratio': self.replayed / max(self.env_steps, 1),
+            'env_steps_per_sec': (self.env_steps - env_steps) / elapsed,
+            'gradient_steps_per_sec': (self.gradient_steps - gradient_steps) / elapsed,
+        }
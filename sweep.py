@@ -0,0 +1,247 @@
+'''
+Hyperparameter sweeps over headless training: every configuration of a grid or random search spec
+trains in a process pool (one torch thread per worker) under a step and/or time budget,
+trials scoring under the median of the others at the same point of their budget stop early.
+
+spec (json):
+    {"method": "grid", "parameters": {"lr": [0.001, 0.0005], "hidden": [[256, 128], [128]]}}
+    {"method": "random", "trials": 20, "parameters": {
+        "lr": {"log_uniform": [1e-4, 1e-2]}, "gamma": {"uniform": [0.8, 0.99]}, "train_every": [1, 4, 16],
+        "epsilon_games": {"int": [40, 200]}, "batch_size": [256, 1000]}}
+
+parameters not in the spec keep DEFAULTS (main.py's constants).
+'''
+import os
+import json
+import time
+import random
+import itertools
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from main import (LR, BATCH_SIZE, MAX_MEMORY, PRIORITIZED_REPLAY, SNAKE_DIMENSIONS,
+                  TRAIN_EVERY, GRADIENT_STEPS, TRAIN_BATCH_SIZE, REPLAY_RATIO, SHORT_MEMORY)
+
+DEFAULTS = {
+    'lr': LR,
+    'batch_size': BATCH_SIZE,
+    'memory_size': MAX_MEMORY,
+    'gamma': .9,
+    'hidden': [256, 128],
+    'epsilon_games': 80,
+    'arena': list(SNAKE_DIMENSIONS),
+    'prioritized': PRIORITIZED_REPLAY,
+    'train_every': TRAIN_EVERY,
+    'gradient_steps': GRADIENT_STEPS,
+    'train_batch_size': TRAIN_BATCH_SIZE,
+    'replay_ratio': REPLAY_RATIO,
+    'short_memory': SHORT_MEMORY,
+}
+
+# fractions of the budget where trials are compared
+RUNGS = (.25, .5, .75)
+
+def _draw(rng: random.Random, values):
+    '''
+    One value of a random search parameter: a list to choose from or {"uniform" | "log_uniform" | "int": [low, high]}
+    '''
+    if isinstance(values, list):
+        return rng.choice(values)
+    (kind, (low, high)), = values.items()
+    if kind == 'uniform':
+        return rng.uniform(low, high)
+    if kind == 'log_uniform':
+        return float(np.exp(rng.uniform(np.log(low), np.log(high))))
+    if kind == 'int':
+        return rng.randint(low, high)
+    raise ValueError(f'Unknown distribution {kind}')
+
+def configurations(spec, seed: int = 0):
+    '''
+    returns: list of full configurations (DEFAULTS overridden by the spec's parameters)
+    '''
+    parameters = spec.get('parameters', {})
+    unknown = set(parameters) - set(DEFAULTS)
+    if unknown:
+        raise ValueError(f'Unknown parameters {sorted(unknown)}')
+
+    method = spec.get('method', 'grid')
+    if method == 'grid':
+        names = list(parameters)
+        return [dict(DEFAULTS, **dict(zip(names, values))) for values in itertools.product(*(parameters[name] for name in names))]
+    if method == 'random':
+        rng = random.Random(seed)
+        return [dict(DEFAULTS, **{name: _draw(rng, values) for name, values in parameters.items()})
+                for _ in range(spec.get('trials', 10))]
+    raise ValueError(f'Unknown search method {method}')
+
+def _init_worker():
+    import torch
+    torch.set_num_threads(1)
+
+def run_trial(trial: int, config, max_steps: int = None, max_seconds: float = None, window: int = 50,
+              board = None, lock = None, min_trials: int = 3, seed: int = 0):
+    '''
+    Trains one configuration until its budget runs out.
+    At every rung of the budget the mean score of the last window games goes to board (shared dict),
+    the trial stops early once it's below the median of at least min_trials others there.
+
+    returns: result record (configuration, objective, counters, why it stopped)
+    '''
+    import torch
+    from main import Agent, play_tick
+    from game import SnakeBasic
+    from scheduler import TrainScheduler
+
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+    agent = Agent(config['prioritized'], (24, *config['hidden'], 4), config['lr'], config['gamma'],
+                  config['batch_size'], config['memory_size'], config['epsilon_games'],
+                  TrainScheduler(config['train_every'], config['gradient_steps'], config['train_batch_size'],
+                                 config['replay_ratio'], config['short_memory']))
+    game = SnakeBasic(tuple(config['arena']), seed)
+
+    scores = deque(maxlen = window)
+    best = 0
+    steps = 0
+    loops_detected = 0
+    loop_ticks_saved_max = 0
+    rung = 0
+    stopped = 'budget'
+    start = time.perf_counter()
+
+    while True:
+        reward, done, score = play_tick(agent, game)
+        steps += 1
+
+        if done:
+            loops_detected += game.loop_detected
+            loop_ticks_saved_max += game.loop_ticks_saved_max
+            game.reset()
+            agent.n_games += 1
+            agent.total_score += score
+            agent.schedule.end_game(agent)
+            scores.append(score)
+            best = max(best, score)
+
+        elapsed = time.perf_counter() - start
+        progress = max(steps / max_steps if max_steps else 0., elapsed / max_seconds if max_seconds else 0.)
+        if progress >= 1.:
+            break
+
+        # compare at the rungs passed, once some games are done
+        if board is not None and rung < len(RUNGS) and progress >= RUNGS[rung] and scores:
+            objective = float(np.mean(scores))
+            with lock:
+                others = board.get(rung, [])
+                board[rung] = others + [objective]
+            rung += 1
+            if len(others) >= min_trials and objective < float(np.median(others)):
+                stopped = f'early@{RUNGS[rung - 1]:g}'
+                break
+
+    elapsed = time.perf_counter() - start
+    return {
+        'trial': trial,
+        **{name: config[name] for name in DEFAULTS},
+        'objective': float(np.mean(scores)) if scores else 0.,
+        'best_score': best,
+        'games': agent.n_games,
+        'steps': steps,
+        'seconds': elapsed,
+        'steps_per_sec': steps / max(elapsed, 1e-9),
+        'gradient_steps_taken': agent.schedule.gradient_steps,
+        'gradient_steps_per_sec': agent.schedule.gradient_steps / max(elapsed, 1e-9),
+        'loops_detected': loops_detected,
+        'loop_ticks_saved_max': loop_ticks_saved_max,
+        'stopped': stopped,
+    }
+
+def sweep(spec, results_path: str = './metrics/sweep.jsonl', workers: int = None, max_steps: int = None,
+          max_seconds: float = None, window: int = 50, early_stopping: bool = True, seed: int = 0):
+    '''
+    Runs every configuration of spec, results are appended to results_path as trials finish
+
+    returns: results ranked by objective
+    '''
+    import multiprocessing
+    from metrics import MetricsSink
+
+    if max_steps is None and max_seconds is None:
+        raise ValueError('Give the trials a budget: max_steps and/or max_seconds')
+
+    configs = configurations(spec, seed)
+    workers = workers or os.cpu_count() or 1
+    context = multiprocessing.get_context('spawn')
+    manager = context.Manager()
+    board, lock = (manager.dict(), manager.Lock()) if early_stopping else (None, None)
+
+    results = []
+    with MetricsSink(results_path) as sink, \
+         ProcessPoolExecutor(min(workers, len(configs)), mp_context = context, initializer = _init_worker) as pool:
+        futures = [pool.submit(run_trial, trial, config, max_steps, max_seconds, window, board, lock, seed = seed + trial)
+                   for trial, config in enumerate(configs)]
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+            sink.log(**result)
+            print(f'trial {result["trial"]}: objective = {result["objective"]:.2f} ({result["stopped"]}, '
+                  f'{result["steps"]} steps, {result["steps_per_sec"]:.0f} steps/sec) [{len(results)}/{len(configs)}]')
+    manager.shutdown()
+
+    return rank(results)
+
+def rank(results):
+    return sorted(results, key = lambda result: -result['objective'])
+
+def format_table(results, top: int = None):
+    '''
+    Ranked results as a text table, one column per swept value
+    '''
+    columns = ['trial'] + [name for name in DEFAULTS if len({str(result.get(name)) for result in results}) > 1] + \
+              ['objective', 'best_score', 'games', 'steps', 'steps_per_sec', 'gradient_steps_per_sec', 'stopped']
+
+    def cell(value):
+        if isinstance(value, float):
+            return f'{value:.4g}'
+        if isinstance(value, list):
+            return 'x'.join(map(str, value))
+        return str(value)
+
+    rows = [[cell(result.get(column, '')) for column in columns] for result in rank(results)[:top]]
+    widths = [max(len(column), *(len(row[index]) for row in rows)) if rows else len(column) for index, column in enumerate(columns)]
+    lines = ['  '.join(column.rjust(width) for column, width in zip(columns, widths))]
+    lines += ['  '.join(value.rjust(width) for value, width in zip(row, widths)) for row in rows]
+    return '\n'.join(lines)
+
+def main(argv = None):
+    import argparse
+    parser = argparse.ArgumentParser(description = 'Parallel hyperparameter sweep over headless training')
+    parser.add_argument('spec', nargs = '?', help = 'json file with the search spec')
+    parser.add_argument('--results', default = './metrics/sweep.jsonl')
+    parser.add_argument('--workers', type = int, default = None, help = 'processes, all cores by default')
+    parser.add_argument('--steps', type = int, default = None, help = 'env steps per trial')
+    parser.add_argument('--seconds', type = float, default = None, help = 'seconds per trial')
+    parser.add_argument('--window', type = int, default = 50, help = 'objective: mean score of the last N games')
+    parser.add_argument('--no-early-stopping', action = 'store_true')
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--rank', action = 'store_true', help = 'only print the ranked results file')
+    parser.add_argument('--top', type = int, default = None)
+    args = parser.parse_args(argv)
+
+    if args.rank:
+        with open(args.results) as file:
+            results = [json.loads(line) for line in file if line.strip()]
+    else:
+        with open(args.spec) as file:
+            spec = json.load(file)
+        results = sweep(spec, args.results, args.workers, args.steps, args.seconds, args.window,
+                        not args.no_early_stopping, args.seed)
+    print(format_table(results, args.top))
+
+if __name__ == '__main__':
+    main()
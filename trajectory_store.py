@@ -0,0 +1,298 @@
+'''
+Transitions on disk: a writer appending them to chunked binary files with a small json index,
+and a reader memory-mapping those files for random-access replay without loading them.
+
+    folder/index.json          chunk files and their record counts, rewritten atomically
+    folder/chunk_000000.bin    RECORD_DTYPE records, chunk_size per file
+
+Records past the count in the index (an interrupted write) are ignored by the reader
+and overwritten when a writer reopens the folder.
+'''
+import os
+import json
+
+import numpy as np
+import torch
+
+from game import SnakeBasic
+
+RECORD_DTYPE = np.dtype([
+    ('state', '<u4'),
+    ('action', 'u1'),
+    ('reward', '<f4'),
+    ('next_state', '<u4'),
+    ('done', '?'),
+    ('episode', '<u4'),
+])
+
+INDEX_FILE = 'index.json'
+
+def _chunk_name(number: int):
+    return f'chunk_{number:06d}.bin'
+
+def read_index(folder: str):
+    with open(os.path.join(folder, INDEX_FILE)) as file:
+        index = json.load(file)
+    if np.dtype([tuple(field) for field in index['dtype']]) != RECORD_DTYPE:
+        raise ValueError(f'{folder} holds records of another format')
+    return index
+
+class TrajectoryWriter:
+    '''
+    Appends transitions to folder, buffering buffer_size of them in memory between writes.
+    The index is rewritten on every flush, so whatever was flushed survives a crash.
+    '''
+    def __init__(self, folder: str, state_size: int = 24, chunk_size: int = 1 << 20, buffer_size: int = 4096):
+        if state_size > 32:
+            raise ValueError('states are stored packed into 32 bits')
+        self.folder = folder
+        self.state_size = state_size
+        self.chunk_size = chunk_size
+        self._powers = 1 << np.arange(state_size, dtype = np.int64)
+
+        self._buffer = np.zeros(buffer_size, dtype = RECORD_DTYPE)
+        self._buffered = 0
+        self._file = None
+
+        if os.path.exists(os.path.join(folder, INDEX_FILE)):
+            index = read_index(folder)
+            if index['state_size'] != state_size:
+                raise ValueError(f'{folder} holds states of size {index["state_size"]}')
+            self.chunk_size = index['chunk_size']
+            self.chunks = index['chunks']
+            self.episode = index['episodes']
+        else:
+            if not os.path.exists(folder):
+                os.makedirs(folder)
+            self.chunks = []
+            self.episode = 0
+
+    def __len__(self):
+        return sum(count for _, count in self.chunks) + self._buffered
+
+    def push(self, state, action, reward, next_state, done):
+        '''
+        Same arguments as ReplayBuffer.push, binary states
+        '''
+        if not isinstance(action, (int, np.integer)):
+            action = int(np.argmax(action))
+
+        record = self._buffer[self._buffered]
+        record['state'] = SnakeBasic.pack_state(state)
+        record['action'] = action
+        record['reward'] = reward
+        record['next_state'] = SnakeBasic.pack_state(next_state)
+        record['done'] = done
+        record['episode'] = self.episode
+        self._buffered += 1
+
+        if done:
+            self.episode += 1
+        if self._buffered == len(self._buffer):
+            self.flush()
+
+    def push_many(self, states, actions, rewards, next_states, dones):
+        '''
+        Same arguments as ReplayBuffer.push_many, (n, state_size) binary states and action indices
+        '''
+        dones = np.asarray(dones, dtype = bool)
+        records = np.zeros(len(dones), dtype = RECORD_DTYPE)
+        records['state'] = np.asarray(states, dtype = np.int64) @ self._powers
+        records['action'] = actions
+        records['reward'] = rewards
+        records['next_state'] = np.asarray(next_states, dtype = np.int64) @ self._powers
+        records['done'] = dones
+        # a transition belongs to the episode of the dones before it
+        records['episode'] = self.episode + np.cumsum(dones) - dones
+        self.episode += int(dones.sum())
+
+        self.flush()
+        self._write(records)
+        self._write_index()
+
+    def flush(self):
+        '''
+        Writes out the buffered transitions and the index
+        '''
+        if self._buffered:
+            self._write(self._buffer[:self._buffered])
+            self._buffered = 0
+            self._write_index()
+
+    def close(self):
+        self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _write(self, records):
+        while len(records):
+            if not self.chunks or self.chunks[-1][1] == self.chunk_size:
+                self._open(len(self.chunks))
+            elif self._file is None:
+                self._open(len(self.chunks) - 1)
+
+            count = min(self.chunk_size - self.chunks[-1][1], len(records))
+            self._file.write(records[:count].tobytes())
+            self.chunks[-1][1] += count
+            records = records[count:]
+        self._file.flush()
+
+    def _open(self, number: int):
+        '''
+        Opens chunk number for appending at its indexed count, dropping anything written past it
+        '''
+        if self._file is not None:
+            self._file.close()
+
+        if number == len(self.chunks):
+            self.chunks.append([_chunk_name(number), 0])
+        name, count = self.chunks[number]
+        path = os.path.join(self.folder, name)
+
+        self._file = open(path, 'r+b' if os.path.exists(path) else 'wb')
+        self._file.truncate(count * RECORD_DTYPE.itemsize)
+        self._file.seek(0, os.SEEK_END)
+
+    def _write_index(self):
+        index = {
+            'dtype': RECORD_DTYPE.descr,
+            'state_size': self.state_size,
+            'chunk_size': self.chunk_size,
+            'chunks': self.chunks,
+            'episodes': self.episode,
+        }
+        path = os.path.join(self.folder, INDEX_FILE)
+        with open(path + '.tmp', 'w') as file:
+            json.dump(index, file)
+        os.replace(path + '.tmp', path)
+
+class TrajectoryStore:
+    '''
+    Read-only view of a folder written by TrajectoryWriter, chunks are memory-mapped
+    so only the sampled records are read from disk. Samples like ReplayBuffer (sample(), batch()).
+    '''
+    def __init__(self, folder: str, seed = None):
+        self.folder = folder
+        self.rng = np.random.default_rng(seed)
+        self._maps = {}
+        self.refresh()
+
+    def refresh(self):
+        '''
+        Rereads the index, picks up what a writer has flushed since
+        '''
+        index = read_index(self.folder)
+        self.state_size = index['state_size']
+        self.episodes = index['episodes']
+
+        self.chunks = []
+        for name, count in index['chunks']:
+            if not count:
+                continue
+            array = self._maps.get(name)
+            if array is None or len(array) < count:
+                array = self._maps[name] = np.memmap(os.path.join(self.folder, name), dtype = RECORD_DTYPE,
+                                                     mode = 'r', shape = (count, ))
+            self.chunks.append(array[:count])
+
+        # first global index of every chunk, and the total at the end
+        self.offsets = np.cumsum([0] + [len(chunk) for chunk in self.chunks])
+        self.size = int(self.offsets[-1])
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def nbytes(self):
+        '''
+        Size of the stored records in bytes (on disk, not in memory)
+        '''
+        return self.size * RECORD_DTYPE.itemsize
+
+    def records(self, indices):
+        '''
+        returns: RECORD_DTYPE array of the transitions at global indices, in that order
+        '''
+        indices = np.asarray(indices, dtype = np.int64)
+        out = np.empty(len(indices), dtype = RECORD_DTYPE)
+
+        chunk_numbers = np.searchsorted(self.offsets, indices, side = 'right') - 1
+        for number in np.unique(chunk_numbers):
+            mask = chunk_numbers == number
+            out[mask] = self.chunks[number][indices[mask] - self.offsets[number]]
+        return out
+
+    def sample_indices(self, batch_size: int):
+        '''
+        Uniform sample with replacement, everything if there's not enough transitions
+        '''
+        if self.size > batch_size:
+            return np.sort(self.rng.integers(0, self.size, batch_size))
+        return np.arange(self.size)
+
+    def batch(self, indices):
+        '''
+        returns: (states, actions, rewards, next_states, dones) tensors, like ReplayBuffer.batch
+        '''
+        records = self.records(indices)
+        return (torch.from_numpy(SnakeBasic.unpack_states(records['state'], self.state_size)),
+                torch.from_numpy(records['action'].astype(np.int64)),
+                torch.from_numpy(records['reward'].copy()),
+                torch.from_numpy(SnakeBasic.unpack_states(records['next_state'], self.state_size)),
+                torch.from_numpy(records['done'].copy()))
+
+    def sample(self, batch_size: int):
+        return self.batch(self.sample_indices(batch_size))
+
+    def episode(self, index: int):
+        '''
+        returns: the records of one episode, in order (scans the episode column)
+        '''
+        return np.concatenate([chunk[chunk['episode'] == index] for chunk in self.chunks] or
+                              [np.zeros(0, dtype = RECORD_DTYPE)])
+
+def train_offline(store: TrajectoryStore, trainer, steps: int, batch_size: int = 1000, report_every: int = 0):
+    '''
+    steps QTrainer updates on batches sampled from the store
+
+    returns: mean squared TD error of every step
+    '''
+    losses = []
+    for step in range(steps):
+        td_errors = trainer.train_step(*store.sample(batch_size))
+        losses.append((td_errors ** 2).mean().item())
+        if report_every and (step + 1) % report_every == 0:
+            print(f'step {step + 1}: loss = {np.mean(losses[-report_every:]):.4f}')
+    return losses
+
+def main(argv = None):
+    import argparse
+    from model import Linear_QNet, QTrainer
+    from main import LR, BATCH_SIZE
+
+    parser = argparse.ArgumentParser(description = 'Train a Linear_QNet offline from recorded transitions')
+    parser.add_argument('folder')
+    parser.add_argument('--steps', type = int, default = 10_000)
+    parser.add_argument('--batch-size', type = int, default = BATCH_SIZE)
+    parser.add_argument('--model', default = None, help = 'start from a saved model')
+    parser.add_argument('--output', default = 'offline.pth', help = 'file name in ./model')
+    args = parser.parse_args(argv)
+
+    store = TrajectoryStore(args.folder)
+    print(f'{len(store)} transitions in {store.episodes} episodes, {store.nbytes / 2 ** 20:.1f} MiB')
+
+    model = Linear_QNet.load(path = args.model) if args.model else Linear_QNet((store.state_size, 256, 128, 4))
+    model.train()
+    trainer = QTrainer(model, lr = LR, gamma = .9)
+    train_offline(store, trainer, args.steps, args.batch_size, report_every = 1000)
+    model.save(args.output)
+
+if __name__ == '__main__':
+    main()
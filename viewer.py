@@ -0,0 +1,194 @@
+'''
+Many games in one window: every game's board is turned into pixels with numpy
+and the whole window goes to the screen with a single surfarray blit.
+'''
+import time
+import random
+
+import numpy as np
+
+import color_settings
+from game import SnakeBasic, SnakeVecEnv, Direction
+
+# palette indices, + DEAD for games that are over
+VOID, BODY, HEAD, APPLE = 0, 1, 2, 3
+DEAD = 4
+
+def _lighter(color, amount: int = 60):
+    return tuple(min(255, channel + amount) for channel in color[:3])
+
+class TiledViewer:
+    '''
+    Lays count games of one arena size out in a grid, cell_size pixels per cell,
+    in its own window or at offset on surface.
+    show() is a no-op until 1 / max_fps has passed since the last frame,
+    so it can be called every tick whatever the simulation rate is.
+
+        viewer = TiledViewer(16, (23, 23))
+        while not viewer.closed:
+            ...
+            viewer.show(games)
+    '''
+    def __init__(self, count: int, arena_size: tuple[int, int], cell_size: int = 6, columns: int = None,
+                 gap: int = 4, max_fps: float = 30., caption: str = 'Snake', surface = None, offset = (0, 0)):
+        import pygame
+        self.pygame = pygame
+
+        self.count = count
+        self.arena_dimensions = arena_size
+        self.cell_size = cell_size
+        self.columns = columns or int(np.ceil(np.sqrt(count)))
+        self.rows = (count + self.columns - 1) // self.columns
+        self.gap = gap
+        self.max_fps = max_fps
+        self.closed = False
+        self.frames = 0
+        self._next_frame = 0.
+
+        width, height = arena_size
+        tile_width, tile_height = width * cell_size, height * cell_size
+        self.width = self.columns * (tile_width + gap) + gap
+        self.height = self.rows * (tile_height + gap) + gap
+
+        if surface is None:
+            pygame.init()
+            surface = pygame.display.set_mode((self.width, self.height))
+            pygame.display.set_caption(caption)
+        # the tiles' area of surface, sharing its pixels
+        self.on_display = surface is pygame.display.get_surface()
+        self.rect = pygame.Rect(offset, (self.width, self.height))
+        self.surface = surface.subsurface(self.rect)
+
+        # colors mapped to surface pixel values
+        colors = [
+            color_settings.BCKG_GAME_COLOR[:3],
+            color_settings.SNAKE_COLOR,
+            _lighter(color_settings.SNAKE_COLOR),
+            color_settings.APPLE_COLOR,
+            color_settings.GRID_COLOR,
+            color_settings.CROSS_COLOR,
+            _lighter(color_settings.CROSS_COLOR),
+            color_settings.APPLE_COLOR,
+        ]
+        self.palette = np.array([self.surface.map_rgb(color) for color in colors], dtype = np.uint32)
+
+        # whole window, indexed [x, y] like pygame.surfarray
+        self.canvas = np.full((self.width, self.height), self.surface.map_rgb(color_settings.BCKG_COLOR), dtype = np.uint32)
+
+        # per game a (W, cell, H * cell) view of its tile: a row of cells stretched along y broadcasts over the cell's columns
+        step_x, step_y = self.canvas.strides
+        self._tiles = []
+        for index in range(count):
+            left = gap + (index % self.columns) * (tile_width + gap)
+            top = gap + (index // self.columns) * (tile_height + gap)
+            tile = self.canvas[left:left + tile_width, top:top + tile_height]
+            self._tiles.append(np.lib.stride_tricks.as_strided(
+                tile, shape = (width, cell_size, tile_height), strides = (step_x * cell_size, step_x, step_y), writeable = True))
+
+        self._planes = np.zeros((count, 3, height, width), dtype = np.uint8)
+        self._env_planes = None
+        self._codes = np.zeros((count, height, width), dtype = np.uint8)
+        self._died = np.zeros(count, dtype = bool)
+
+    def due(self):
+        '''
+        returns: whether the next show() will draw a frame
+        '''
+        return self.max_fps is None or time.perf_counter() >= self._next_frame
+
+    def show(self, games, force: bool = False):
+        '''
+        Draws the first count games, games is a list of SnakeBasic or a SnakeVecEnv
+
+        returns: whether a frame was drawn
+        '''
+        if self.on_display:
+            for event in self.pygame.event.get(self.pygame.QUIT):
+                self.closed = True
+
+        if not force and not self.due():
+            return False
+        if self.max_fps:
+            self._next_frame = time.perf_counter() + 1 / self.max_fps
+
+        self.render(self.observe(games))
+        self.pygame.surfarray.blit_array(self.surface, self.canvas)
+        if self.on_display:
+            self.pygame.display.update(self.rect)
+        self.frames += 1
+        return True
+
+    def observe(self, games):
+        '''
+        returns: (count, 3, H, W) planes of the first count games, died flags are read into self._died
+        '''
+        if isinstance(games, SnakeVecEnv):
+            if self._env_planes is None or len(self._env_planes) != games.num_envs:
+                self._env_planes = np.zeros((games.num_envs, 3) + self._planes.shape[2:], dtype = np.uint8)
+            count = min(self.count, games.num_envs)
+            self._planes[:count] = games.get_grid_observations(self._env_planes)[:count]
+            self._died[:count] = games.died[:count]
+        else:
+            count = min(self.count, len(games))
+            SnakeBasic.get_grid_observations(games[:count], self._planes[:count])
+            self._died[:count] = [game.died for game in games[:count]]
+
+        # tiles without a game stay empty
+        self._planes[count:] = 0
+        self._died[count:] = False
+        return self._planes
+
+    def render(self, planes):
+        '''
+        Writes (count, 3, H, W) planes into the canvas, one array write per game
+        '''
+        codes = self._codes
+        np.add(planes[:, 0], planes[:, 1], out = codes)
+        codes += planes[:, 2] * APPLE
+        codes[self._died] += DEAD
+
+        # pixel values indexed [game, x, y * cell]
+        colors = np.repeat(self.palette[codes.transpose(0, 2, 1)], self.cell_size, axis = 2)
+        for tile, color in zip(self._tiles, colors):
+            tile[:] = color[:, None]
+
+def main(argv = None):
+    import argparse
+    parser = argparse.ArgumentParser(description = 'Watch many games at once')
+    parser.add_argument('--games', type = int, default = 16)
+    parser.add_argument('--arena', type = int, nargs = 2, default = (23, 23), metavar = ('W', 'H'))
+    parser.add_argument('--cell-size', type = int, default = 6)
+    parser.add_argument('--fps', type = float, default = 30.)
+    parser.add_argument('--model', default = None, help = 'play greedily with a saved Linear_QNet instead of random safe moves')
+    args = parser.parse_args(argv)
+
+    games = [SnakeBasic(tuple(args.arena), seed) for seed in range(args.games)]
+    viewer = TiledViewer(args.games, tuple(args.arena), args.cell_size, max_fps = args.fps)
+
+    inference = None
+    if args.model:
+        from model import Linear_QNet, QInference
+        inference = QInference(Linear_QNet.load(path = args.model))
+    rng = random.Random(0)
+
+    ticks = 0
+    start = time.perf_counter()
+    while not viewer.closed:
+        if inference is not None:
+            moves = inference.act(np.array([game._get_basic_input_bin() for game in games], dtype = np.float32))
+        else:
+            moves = [Direction.directions.index(rng.choice(game._get_nice_moves() or Direction.directions)) for game in games]
+            for game in games:
+                game.forget_positions()
+
+        for game, move in zip(games, moves):
+            if game.tick(int(move))[1]:
+                game.reset()
+        ticks += len(games)
+
+        if viewer.show(games) and viewer.frames % 100 == 0:
+            elapsed = time.perf_counter() - start
+            print(f'{ticks / elapsed:.0f} ticks/sec, {viewer.frames / elapsed:.1f} fps')
+
+if __name__ == '__main__':
+    main()